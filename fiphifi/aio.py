@@ -0,0 +1,329 @@
+'''Single event loop runtime: playlist polling, downloads, metadata and
+   icecast output as coroutines instead of threads. Needs aiohttp.'''
+
+import time
+import json
+import queue
+import signal
+import asyncio
+import logging
+import threading
+from fiphifi.util import get_tmpdir
+from fiphifi.playlist import FipPlaylist
+from fiphifi.metadata import FIPMetadata
+from fiphifi.demux import ADTSDemuxer
+from fiphifi.pacer import Pacer
+from fiphifi.drift import DriftController
+from fiphifi.icecast import IcecastSource
+from fiphifi.store import segmentname
+from fiphifi.buffer import Buffer
+from fiphifi.constants import TSLENGTH, BUFFERSIZE, DLWORKERS
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__package__+'.aio')
+
+
+class AsyncIcecastSource():
+    '''Coroutine twin of IcecastSource; write() returns once the data is
+       on the wire, reconnecting with bounded back-off as needed.'''
+
+    def __init__(self, _c):
+        self.settings = IcecastSource(_c)
+        self.writer = None
+        self._delay = self.settings.backoff[0]
+        self.connects = 0
+        self.sent = 0
+
+    async def connect(self):
+        _s = self.settings
+        _reader, _writer = await asyncio.wait_for(asyncio.open_connection(_s.host, _s.port), _s.timeout)
+        try:
+            _head = ''.join(f'{_k}: {_v}\r\n' for _k, _v in _s.headers.items())
+            _writer.write(f'PUT {_s.mount} HTTP/1.1\r\n{_head}\r\n'.encode())
+            _resp = await asyncio.wait_for(_reader.readuntil(b'\r\n\r\n'), _s.timeout)
+            try:
+                _status = int(_resp.split(b'\r\n')[0].split()[1])
+            except (IndexError, ValueError):
+                _status = 0
+            if _status not in (100, 200):
+                raise ConnectionError(f'Icecast refused {_s.mount} ({_status})')
+        except BaseException:
+            _writer.close()
+            raise
+        self.writer = _writer
+        self.connects += 1
+        logger.info("Connected to %s:%s%s (%s)", _s.host, _s.port, _s.mount, self.connects)
+
+    async def write(self, data):
+        while True:
+            if self.writer is None:
+                try:
+                    await self.connect()
+                    self._delay = self.settings.backoff[0]
+                except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError) as msg:
+                    logger.warning("Could not connect to icecast: %s", msg)
+                    await asyncio.sleep(self._delay)
+                    self._delay = min(self._delay * 2, self.settings.backoff[1])
+                    continue
+            try:
+                self.writer.write(data)
+                await asyncio.wait_for(self.writer.drain(), self.settings.timeout)
+                self.sent += len(data)
+                return
+            except (OSError, ConnectionError, asyncio.TimeoutError) as msg:
+                logger.warning("Lost connection to icecast: %s", msg)
+                self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+
+
+class AsyncRuntime():
+
+    framesize = 10
+
+    def __init__(self, opts, config, store, cache, station=None):
+        self.delay = opts.delay
+        self._c = config['USEROPTS']
+        self.store = store
+        self._alive = threading.Event()
+        self._alive.set()
+        #  FipPlaylist.ingest_url only ever put_nowait()s, so it can feed the loop directly
+        self.dlqueue = asyncio.Queue()
+        self.playlist = FipPlaylist(self._alive, self.dlqueue, cache, delay=self.delay, station=station)
+        self.metadata = FIPMetadata(self._alive, tmpdir=get_tmpdir(self._c), delay=self.delay, station=station)
+        self.station = self.playlist.station
+        self.workers = self._c.getint('DLWORKERS', fallback=DLWORKERS) or 1
+        self.source = AsyncIcecastSource(self._c)
+        self.controller = DriftController(self.delay)
+        self.session = None
+        self.timestamp = 0
+        self.lastts = b''
+        #  url -> the one fetch in flight for it, shared by download() and playout()
+        self._flights = {}
+        #  Set whenever the playlist queues new urls, for playout to wait on
+        self._arrived = asyncio.Event()
+
+    async def run(self):
+        _loop = asyncio.get_running_loop()
+        _main = asyncio.current_task()
+        for _sig in (signal.SIGINT, signal.SIGTERM):
+            _loop.add_signal_handler(_sig, _main.cancel)
+        _connector = aiohttp.TCPConnector(limit=self.workers + 4)
+        async with aiohttp.ClientSession(connector=_connector) as self.session:
+            _tasks = [asyncio.create_task(self.poll_playlist(), name='playlist'),
+                      asyncio.create_task(self.poll_metadata(), name='metadata'),
+                      asyncio.create_task(self.stream(), name='stream')]
+            _tasks += [asyncio.create_task(self.download(), name=f'download {_i}')
+                       for _i in range(self.workers)]
+            try:
+                await asyncio.gather(*_tasks)
+            except asyncio.CancelledError:
+                logger.warning("Event loop cancelled, shutting down.")
+            except Exception as msg:
+                logger.error("A task died, shutting down: %s", msg)
+            finally:
+                for _task in _tasks:
+                    _task.cancel()
+                await asyncio.gather(*_tasks, return_exceptions=True)
+                self.source.close()
+                logger.info('Wrote %s urls to cache', self.playlist.writecache())
+                self.metadata._writetodisk()
+
+    async def poll_playlist(self):
+        self.playlist.checkhistory()
+        self.playlist.setoffset()
+        retries = 0
+        while True:
+            try:
+                async with self.session.get(self.station.listurl, timeout=aiohttp.ClientTimeout(total=5)) as req:
+                    self.playlist.parselist(await req.text())
+                self._arrived.set()
+                retries = 0
+            except (aiohttp.ClientError, asyncio.TimeoutError) as msg:
+                retries += 1
+                if retries > 9:
+                    raise ConnectionError("Maximum playlist retries reached") from msg
+                logger.warning("Playlist error, retrying (%s): %s", retries, msg)
+                await asyncio.sleep(1)
+                continue
+            finally:
+                #  The journal is fsynced, which must not hold up the paced playout
+                await asyncio.to_thread(self.playlist.writecache)
+            self.playlist.trim()
+            await asyncio.sleep(self.playlist.delay)
+
+    async def poll_metadata(self):
+        while True:
+            _delay = 5
+            try:
+                async with self.session.get(self.metadata.metaurl, timeout=aiohttp.ClientTimeout(total=5)) as req:
+                    if req.status == 200:
+                        _delay = self.metadata._ingest(await req.json(content_type=None))
+                        #  Snapshots to disk now and then
+                        await asyncio.to_thread(self.metadata._record)
+                    else:
+                        logger.warning('Error fetching metadata: %s', req.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as msg:
+                logger.error("Error fetching metadata from Fip: %s", msg)
+            await asyncio.sleep(max(_delay, 1))
+
+    async def download(self):
+        while True:
+            _url = await self.dlqueue.get()
+            try:
+                await asyncio.wait_for(self.fetch(_url), TSLENGTH * BUFFERSIZE)
+            except asyncio.TimeoutError:
+                logger.warning("Missed deadline for %s", segmentname(_url))
+
+    async def fetch(self, url):
+        if segmentname(url) in self.store:
+            return True
+        _flight = self._flights.get(url)
+        if _flight is None:
+            _flight = self._flights[url] = asyncio.ensure_future(
+                asyncio.wait_for(self._fetch(url), TSLENGTH * BUFFERSIZE))
+            _flight.add_done_callback(lambda _f: self._landed(url, _f))
+        #  A caller giving up (wait_for) must not cancel the fetch for the others
+        return await asyncio.shield(_flight)
+
+    def _landed(self, url, flight):
+        self._flights.pop(url, None)
+        if not flight.cancelled() and flight.exception() is not None:
+            logger.debug("Gave up on %s: %r", segmentname(url), flight.exception())
+
+    async def _fetch(self, url):
+        _backoff = 0.25
+        while True:
+            try:
+                async with self.session.get(url, timeout=aiohttp.ClientTimeout(total=TSLENGTH)) as req:
+                    if req.status == 404:
+                        logger.error("%s not found", url)
+                        return False
+                    if req.status == 200:
+                        _data = await req.read()
+                        if len(_data) > 4096:
+                            #  Refused if it has been played already
+                            if not await asyncio.to_thread(self.store.put, segmentname(url), _data):
+                                return False
+                            self.lastts = _data
+                            return True
+                    logger.warning("Got response code: %s", req.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            logger.warning("Retrying %s", url)
+            await asyncio.sleep(_backoff)
+            _backoff = min(_backoff * 2, TSLENGTH)
+
+    async def stream(self):
+        try:
+            _epoch = self.playlist.history[0][0]
+            logger.info("Restarting from cached history")
+        except IndexError:
+            _epoch = time.time()
+        _vamp = asyncio.create_task(self.vamp(), name='vamp')
+        try:
+            while time.time() - _epoch < self.delay:
+                _remains = (self.delay - (time.time() - _epoch)) / 60 or 1
+                logger.info('(%0.0f%%) Buffering for %0.0f more min',
+                            (self.playlist.qsize * TSLENGTH / self.delay) * 100, _remains)
+                await self.announce(f"Realtime Stream: T-{_remains:0.0f} minutes")
+                await asyncio.sleep(min(60, max(self.delay - (time.time() - _epoch), 0)))
+        finally:
+            _vamp.cancel()
+            await asyncio.gather(_vamp, return_exceptions=True)
+        await asyncio.gather(self.playout(), self.follow())
+
+    async def vamp(self):
+        while True:
+            try:
+                async with self.session.get(self.station.liveurl, timeout=aiohttp.ClientTimeout(sock_read=10)) as req:
+                    async for _chunk in req.content.iter_chunked(4096):
+                        await self.source.write(_chunk)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as msg:
+                logger.warning("Lost live stream: %s", msg)
+            await asyncio.sleep(1)
+
+    async def playout(self):
+        demuxer = ADTSDemuxer()
+        pacer = Pacer()
+        while True:
+            try:
+                _timestamp, _url = self.playlist.urlq.get_nowait()
+            except queue.Empty:
+                #  Nothing else touches the queue between the check and the wait
+                self._arrived.clear()
+                await self._arrived.wait()
+                continue
+            _ts = segmentname(_url)
+            if _timestamp and time.time() - _timestamp - self.delay > Buffer.skipafter:
+                logger.warning("Skipping %s, %0.0fs past the delay.", _ts, time.time() - _timestamp - self.delay)
+                await asyncio.to_thread(self.store.discard, _ts)
+                continue
+            if _ts not in self.store:
+                try:
+                    await asyncio.wait_for(self.fetch(_url), TSLENGTH * BUFFERSIZE)
+                except asyncio.TimeoutError:
+                    pass
+            if _ts not in self.store and self.lastts:
+                logger.warning("Inserting garbage for %s", _ts)
+                await asyncio.to_thread(self.store.put, _ts, self.lastts)
+            #  File and ring stores hit the disk, so keep them off the loop
+            _data = await asyncio.to_thread(self.store.get, _ts)
+            if _data is None:
+                continue
+            _frames = list(demuxer.feed(_data))
+            if demuxer.samplerate:
+                pacer.samplerate = demuxer.samplerate
+            if _timestamp:
+                #  The segment is heard once the frames already sent have played out
+                _heard = _timestamp - max(pacer.samples - pacer.clock, 0) / pacer.samplerate
+                _frames = self.controller.correct(_frames, time.time() - _heard - self.delay,
+                                                  pacer.samplerate)
+            self.timestamp = _timestamp
+            for _i in range(0, len(_frames), self.framesize):
+                _group = _frames[_i:_i + self.framesize]
+                _wait = pacer.schedule()
+                if _wait > 0:
+                    await asyncio.sleep(_wait)
+                pacer.advance(len(_group))
+                await self.source.write(b''.join(_group))
+            await asyncio.to_thread(self.store.discard, _ts)
+
+    async def follow(self):
+        last_slug = ''
+        while True:
+            await asyncio.sleep(1)
+            _meta = self.metadata.pop(self.timestamp)
+            if not _meta:
+                continue
+            slug = f'"{_meta.get("track")}" by {_meta.get("artist")} on {_meta.get("album")}'
+            if slug != last_slug and await self.announce(slug):
+                last_slug = slug
+
+    async def announce(self, slug):
+        _params = {'mode': 'updinfo', 'mount': f"/{self._c['MOUNT']}", 'song': slug}
+        try:
+            async with self.session.get(f"http://{self._c['HOST']}:{self._c['PORT']}/admin/metadata",
+                                        params=_params,
+                                        auth=aiohttp.BasicAuth(self._c['USER'], self._c['PASSWORD']),
+                                        timeout=aiohttp.ClientTimeout(total=5)) as req:
+                if 'Metadata update successful' in await req.text():
+                    logger.info('Metadata udpate: %s', slug)
+                    return True
+                logger.warning('Error updating metdata: %s', req.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.warning('Metadata update failed to communicate with icecast.')
+        return False
+
+
+def run(opts, config, store, cache, station=None):
+    if aiohttp is None:
+        raise ImportError("The asyncio runtime needs aiohttp (pip install aiohttp).")
+    asyncio.run(AsyncRuntime(opts, config, store, cache, station).run())
@@ -4,9 +4,16 @@ import logging
 import threading
 import queue
 import subprocess
-import requests
-import psutil
 from fiphifi.util import parsets, get_tmpdir
+from fiphifi.demux import ADTSDemuxer, SAMPLESPERFRAME
+from fiphifi.pacer import Pacer, Timeline
+from fiphifi.drift import DriftController
+from fiphifi.store import segmentname
+from fiphifi.stations import stationof
+from fiphifi.pipeline import Stage
+from fiphifi.icecast import IcecastSource
+from fiphifi.listen import HTTPSink
+from fiphifi.downloader import Downloader
 from fiphifi.constants import BUFFERSIZE, TSLENGTH
 
 logger = logging.getLogger(__package__+'.buffer')
@@ -14,15 +21,11 @@ SILENTAAC2 = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'silence_
 SILENTAAC4 = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'silence_2s.ts')
 
 
-def delayedstream(_c, playlist):
+def delayedstream(_c):
     _ffmpegcmd = [_c['FFMPEG'],
                   '-loglevel', 'warning',
-                  '-nostdin',
-                  '-re',
-                  '-stream_loop', '-1',
-                  '-safe', '0',
-                  '-i', playlist,
-                  '-f', '-concat',
+                  '-f', 'aac',
+                  '-i', 'pipe:0',
                   '-flush_packets', '0',
                   '-content_type', 'audio/aac',
                   '-ice_name', 'FipShift',
@@ -39,106 +42,72 @@ def delayedstream(_c, playlist):
 class Buffer(threading.Thread):
 
     duration = TSLENGTH
+    #  Further behind than frame-level correction can make up in reasonable time
+    skipafter = TSLENGTH * BUFFERSIZE * 3
 
-    def __init__(self, _alive, urlq, config):
+    def __init__(self, _alive, urlq, config, store, delay=0, fetcher=None):
         threading.Thread.__init__(self)
         self.name = 'Buffer Thread'
         self._alive = _alive
         self.urlq = urlq
-        self.dldir = os.path.join(get_tmpdir(config['USEROPTS']), 'ts')
-        self._timestamp = [[0, time.time()]]
-        self.last_timestamp = 0
-        self.playlist = Playlist(config)
+        self.store = store
+        self.delay = delay
+        #  Fetches go through the Downloader, so a segment it is already
+        #  fetching is waited for rather than fetched twice
+        self.fetcher = fetcher or Downloader(_alive, None, config, store)
+        self.skipped = 0
+        self.garbage = 0
+        self.playlist = Playlist(config, store, delay)
         with open(SILENTAAC4, 'rb') as fh:
             self.lastts = fh.read()
 
     def run(self):
         logger.info('Starting Buffer')
-        session = requests.Session()
         try:
             while self.alive:
-                if not self.advance(session):
-                    session = requests.Session()
+                self.advance()
         except Exception as msg:
             logger.error("%s died %s", self.name, str(msg))
         finally:
             self.playlist.cleanup()
             logger.warning('%s ending.', self.name)
 
-    def advance(self, session):
+    def advance(self):
         self.playlist.next()
-        if self.playlist.buffersize > BUFFERSIZE:
-            time.sleep(0.5)
-            return True
         success = False
         try:
             _timestamp, _url = self.urlq.get(timeout=self.duration)
-            _ts = os.path.join(self.dldir, os.path.basename(_url.split('?')[0]))
-            if os.path.exists(_ts):
-                success = True
-            _retry_start = time.time()
-            while not success:
-                if time.time() - _retry_start >= self.duration * BUFFERSIZE:
-                    logger.warning("%s could not download %s", self.name, os.path.basename(_url))
-                    break
-                req = self._get_url(session, _url)
-                if req is not None:
-                    if not req.ok:
-                        logger.warning("%s bad url %s", self.name, _url)
-                        break
-                    with open(_ts, 'wb') as fh:
-                        fh.write(req.content)
-                    if os.path.getsize(_ts) > 4096:
-                        logger.debug('%s wrote %s (%0.0f kb)', self.name, _ts, os.path.getsize(_ts) / 1024)
-                        with open(_ts, 'rb') as fh:
-                            self.lastts = fh.read()
-                        success = True
-                    else:
-                        logger.debug("%s req: %s", self.name, req.content)
-                        logger.warning("%s %s empty, retrying", self.name, os.path.basename(_url))
-                        time.sleep(1)
+            _ts = segmentname(_url)
+            if _timestamp and self.delay and time.time() - _timestamp - self.delay > self.skipafter:
+                logger.warning("%s skipping %s, %0.0fs past the delay.",
+                               self.name, _ts, time.time() - _timestamp - self.delay)
+                self.store.discard(_ts)
+                self.skipped += 1
+                return True
+            success = self.fetcher.fetch(_url, time.time() + self.duration * BUFFERSIZE)
             if not success:
-                logger.warning("%s inserting garbage for %s", self.name, _ts)
-                with open(_ts, 'wb') as fh:
-                    fh.write(self.lastts)
-            self.playlist.add(_ts)
-            self._timestamp.append([parsets(_ts)[1], _timestamp])
+                logger.warning("%s could not download %s, inserting garbage.", self.name, _ts)
+                #  This station's last good segment, or silence until there is one
+                if not self.store.put(_ts, self.fetcher.lastts.get(stationof(_ts)) or self.lastts):
+                    #  Refused: it has been played already
+                    logger.warning("%s store refused %s, skipping it.", self.name, _ts)
+                    self.skipped += 1
+                    return False
+                self.garbage += 1
+            while self.alive:
+                try:
+                    self.playlist.add(_ts, _timestamp, timeout=self.duration)
+                    break
+                except queue.Full:
+                    self.playlist.next()
         except queue.Empty:
             logger.warning('%s url queue empty.', self.name)
             time.sleep(self.duration)
         return success
 
-    def _get_url(self, session, url):
-        req = None
-        for _i in range(3, 30, 3):
-            try:
-                req = session.get(url, timeout=self.duration)
-                if req is not None:
-                    if req.ok:
-                        return req
-                    elif req.status_code == 404:
-                        logger.error("%s not found", url)
-                        return None
-                    else:
-                        logger.warning("Got response code: %s", req.status_code)
-                        time.sleep(_i)
-            except (requests.exceptions.ConnectTimeout,
-                    requests.exceptions.ReadTimeout,
-                    requests.exceptions.ConnectionError):
-                pass
-            logger.warning("Retrying %s", url)
-        return req
-
     @property
     def timestamp(self):
-        _timestamp = self.last_timestamp
-        for _i, _item in enumerate(self._timestamp):
-            if _item[0] == self.playlist.nowplaying:
-                _timestamp = _item[1]
-                self.last_timestamp = _timestamp
-                self._timestamp = self._timestamp[_i:]
-                break
-        return _timestamp
+        return self.playlist.timestamp
 
     @property
     def alive(self):
@@ -148,6 +117,14 @@ class Buffer(threading.Thread):
     def initialized(self):
         return self.playlist.initialized
 
+    @property
+    def drift(self):
+        return self.playlist.drift
+
+    @property
+    def controller(self):
+        return self.playlist.controller
+
     @property
     def tslength(self):
         return self.duration
@@ -159,159 +136,167 @@ class Buffer(threading.Thread):
         else:
             logger.error("%s not setting tslength < 0", self.name)
 
-class Playlist():
-
-    duration = TSLENGTH
-
-    def __init__(self, config):
-        self.config = config
-        self.dldir = os.path.join(get_tmpdir(self.config['USEROPTS']), 'ts')
-        self.playlist = os.path.join(self.dldir, 'playlist.txt')
-        self.tsfiles = ("first.ts", "second.ts")
-        self.ffmpeg_proc = None
-        self.tsqueue = queue.SimpleQueue()
-        self.current = {-1: 0, 0: 0, 1: 0}
-        self._lastupdate = 0
-        self.last_pls = -1
-        self.initialized = False
-        if not os.path.exists(self.playlist):
-            self._create_playlist()
-
-    def _create_playlist(self):
-        with open(self.playlist, 'w') as fh:
-            fh.write('ffconcat version 1.0\n')
-            fh.write(f"file '{self.tsfiles[0]}'\n")
-            fh.write(f"file '{self.tsfiles[1]}'\n")
-        if os.path.exists(self.playlist):
-            logger.info("Created %s", self.playlist)
-        else:
-            logger.error("Could not create %s", self.playlist)
-            raise OSError(f"Could not create {self.playlist}")
+class FFmpegSink():
+    '''Pipe ADTS into one long-lived ffmpeg that pushes it to icecast.'''
 
-    def _update(self, _src, _i):
-        _ts = os.path.join(self.dldir, self.tsfiles[_i])
-        try:
-            if os.path.getsize(_src) == 0:
-                logger.warning("Refusing to write empty file %s.", _src)
-            else:
-                os.replace(_src, _ts)
-            logger.debug("%s: %0.0f kb", _ts, os.path.getsize(_ts) / 1024)
-            self.current[_i] = parsets(_src)[1]
-            self._lastupdate = time.time()
-            logger.info("Playlist 0: %s, 1: %s", self.current[0], self.current[1])
-        except (OSError, FileNotFoundError):
-            logger.error("Error reading %s, cannot add to playlist", _src)
+    def __init__(self, _c):
+        self._c = _c
+        self.proc = None
+        self.restarts = 0
 
-    def _init_ffmpeg(self):
-        if self.ffmpeg_alive:
+    def open(self):
+        if self.alive:
             logger.debug("ffmpeg already running, not initializing.")
             return
+        if self.proc is not None:
+            self.restarts += 1
         logger.info('Starting ffmpeg')
-        if self.initialized and not self.ffmpeg_healthy:
-            self._advance_playlist(force=True)
-        self.ffmpeg_proc = delayedstream(self.config['USEROPTS'], self.playlist)
-        time.sleep(1)
-        if not self.ffmpeg_alive:
+        self.proc = delayedstream(self._c)
+        if not self.alive:
             logger.error("Failed to start ffmpeg")
 
-    def _get_ffmpeg_proc(self):
-        if not self.ffmpeg_alive:
-            logger.debug("ffmpeg is not alive, calling init_ffmpeg")
-            self._init_ffmpeg()
-        if self.ffmpeg_alive:
+    def write(self, data):
+        if not self.alive:
+            logger.warning("ffmpeg is not running, restarting.")
+            self.open()
+        try:
+            _n = self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError):
+            logger.warning("ffmpeg pipe closed.")
+            self.close()
+            time.sleep(1)
+            return 0
+        return _n
+
+    def close(self):
+        if self.proc is None:
+            return
+        #  Terminate first so a feeder blocked on a full pipe gets EPIPE
+        if self.alive:
+            self.proc.terminate()
             try:
-                return psutil.Process(self.ffmpeg_pid)
-            except psutil.NoSuchProcess as msg:
-                logger.warning("Error updating playlist: %s", msg)
+                self.proc.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        try:
+            self.proc.stdin.close()
+        except (BrokenPipeError, OSError, ValueError):
+            pass
+
+    @property
+    def pid(self):
+        if self.alive:
+            return self.proc.pid
         return None
 
+    @property
+    def alive(self):
+        if self.proc is None:
+            return False
+        if self.proc.poll() is None:
+            return True
+        return False
+
+
+class Playlist():
+
+    duration = TSLENGTH
+    framesize = 10
+
+    def __init__(self, config, store, delay=0):
+        self.config = config
+        self.store = store
+        _playout = self.config['USEROPTS'].get('PLAYOUT', 'native')
+        if _playout == 'native':
+            self.sink = IcecastSource(self.config['USEROPTS'])
+        elif _playout == 'http':
+            self.sink = HTTPSink(self.config['USEROPTS'])
+        else:
+            self.sink = FFmpegSink(self.config['USEROPTS'])
+        #  Stored segments waiting for the pacer; a full queue holds up the Buffer
+        self.tsqueue = Stage(f"playout /{self.config['USEROPTS']['MOUNT']}", BUFFERSIZE)
+        self.demuxer = ADTSDemuxer()
+        self.pacer = Pacer()
+        #  Segments still between us and the listener
+        self.timeline = Timeline()
+        self.controller = DriftController(delay)
+        self._lastupdate = 0
+        self._feeding = threading.Event()
+        self._feeder = None
+        self.initialized = False
+
     def _init_playlist(self):
-        if self.tsqueue.qsize() < len(self.tsfiles):
-            logger.info("Playlist waiting for queue to fill before initializing.")
-            return
         if self.initialized:
             return
-        for _i, _ts in enumerate(self.tsfiles):
-            _src = self.tsqueue.get()
-            self._update(_src, _i)
-        self._init_ffmpeg()
+        if self.tsqueue.qsize() < 2:
+            logger.info("Playlist waiting for queue to fill before initializing.")
+            return
+        if isinstance(self.sink, FFmpegSink):
+            self.sink.open()
+        self._feeding.set()
+        self._lastupdate = time.time()
+        self._feeder = threading.Thread(target=self._feed, name='Playlist Feeder')
+        self._feeder.start()
         self.initialized = True
-        self._get_playing()
 
-    def _advance_playlist(self, force=False):
+    def _feed(self):
+        while self._feeding.is_set():
+            try:
+                _src, _timestamp = self.tsqueue.get(timeout=self.duration)
+            except queue.Empty:
+                logger.warning("Can't feed playout when queue is empty.")
+                continue
+            self._write(_src, _timestamp)
+        logger.debug("Playlist feeder ending.")
+
+    def _write(self, _src, _timestamp=0):
+        _data = self.store.get(_src)
+        if _data is None:
+            logger.error("Error reading %s, cannot add to playlist", _src)
+            return
+        _frames = list(self.demuxer.feed(_data))
+        if not _frames:
+            logger.warning("Refusing to write empty file %s.", _src)
+            return
+        if self.demuxer.samplerate:
+            self.pacer.samplerate = self.demuxer.samplerate
+        _heard = self.timeline.when(self.pacer.position, self.pacer.samplerate)
+        if _heard and self.controller.delay:
+            _frames = self.controller.correct(_frames, time.time() - _heard - self.controller.delay,
+                                              self.pacer.samplerate)
+        _start = self.pacer.samples
+        self.timeline.push(_start + len(_frames) * SAMPLESPERFRAME,
+                           parsets(_src)[1], _timestamp, _start)
+        for _i in range(0, len(_frames), self.framesize):
+            if not self._feeding.is_set():
+                break
+            _group = _frames[_i:_i + self.framesize]
+            self.pacer.wait(len(_group))
+            self.timeline.advance(self.pacer.position)
+            _view = memoryview(b''.join(_group))
+            while _view and self._feeding.is_set():
+                _view = _view[self.sink.write(_view):]
+        self._lastupdate = time.time()
+        logger.debug("Playlist fed %s (%s frames)", _src, len(_frames))
+        self.store.discard(_src)
+
+    def add(self, tsfile, timestamp=0, timeout=None):
+        self.tsqueue.put((tsfile, timestamp), timeout=timeout)
+        logger.debug("Playlist queued %s", tsfile)
+        self._init_playlist()
+
+    def next(self):
         if not self.initialized:
-            logger.debug("Not advancing playlist until initialized.")
             self._init_playlist()
-            return -1
-        if self.tsqueue.qsize() > BUFFERSIZE:
-            logger.debug("Playlist length %s > buffersize %s.", self.tsqueue.qsize(), BUFFERSIZE)
-        if self.tsqueue.empty():
-            logger.warning("Can't advance playlist when queue is empty.")
-            return -1
-        # if force and self.tsqueue.qsize() >= len(self.tsfiles):
-        if force:
-            logger.info("Forcing update")
-            playing = 0
-            self.current[0] = self.current[1] + 1
-        #  Check to see which idx is playing
-        #  and then make sure the next idx is
-        #  larger than the current one
-        else:
-            playing = self._get_playing()
-        if playing == 0:
-            # logger.debug("Checking if %s > %s", self.current[0], self.current[1])
-            #  If we are playing idx 0 and it is larger than idx 1
-            #  we have to update idx 1 to the next item in the queue
-            if self.current[0] > self.current[1]:
-                _src = self.tsqueue.get()
-                self._update(_src, 1)
-        elif playing == 1:
-            # logger.debug("Checking if %s > %s", self.current[1], self.current[0])
-            #  If we are playing idx 1 and it is larger than idx 0
-            #  we have to update idx 0 to the next item in the queue
-            if self.current[1] > self.current[0]:
-                _src = self.tsqueue.get()
-                self._update(_src, 0)
-        return playing
-
-    def _get_playing(self):
-        if self.lastupdate > self.duration+1 and self.lastupdate < 1000:
+        elif self.lastupdate > self.duration + 1:
             logger.warning("Playlist updated more than %ss ago (%0.0f)", self.duration, self.lastupdate)
-        if 1000 > self.lastupdate > 60:
-            logger.warning("It's been more than a minute, dying.")
-            raise OSError("Playlist neglected!")
-        proc = self._get_ffmpeg_proc()
-        if proc is None:
-            return -1
-        try:
-            for item in proc.open_files():
-                for _i, _ts in enumerate(self.tsfiles):
-                    if os.path.basename(item.path) == os.path.basename(_ts):
-                        self.last_pls = _i
-                        return _i
-        except psutil.ZombieProcess:
-            logger.error("FFMPEG is a zombie process!")
-        logger.warning("Playlist could not determine what ffmpeg is currently playing.")
-        return -1
-
-    def add(self, tsfile):
-        logger.debug("Playlist queued %s", os.path.basename(tsfile))
-        self.tsqueue.put(tsfile)
-        self._advance_playlist()
-
-    def next(self):
-        self._advance_playlist()
 
     def cleanup(self):
-        if self.ffmpeg_alive:
-            self.ffmpeg_proc.terminate()
-            time.sleep(1)
-            if self.ffmpeg_alive:
-                self.ffmpeg_proc.kill()
-        try:
-            os.unlink(self.playlist)
-        except FileNotFoundError:
-            pass
+        self._feeding.clear()
+        self.sink.close()
+        if self._feeder is not None:
+            self._feeder.join(timeout=self.duration)
 
     @property
     def lastupdate(self):
@@ -319,35 +304,24 @@ class Playlist():
 
     @property
     def nowplaying(self):
-        return self.current[self._advance_playlist()]
+        return self.timeline.at(self.pacer.position)[0]
 
     @property
-    def buffersize(self):
-        #  The real buffer should be BUFFERSIZE - 1 because the playlist is two items long
-        return self.tsqueue.qsize() + 1
+    def timestamp(self):
+        return self.timeline.at(self.pacer.position)[1]
 
     @property
-    def ffmpeg_pid(self):
-        if self.ffmpeg_alive:
-            return self.ffmpeg_proc.pid
-        return None
+    def drift(self):
+        return self.pacer.drift
 
     @property
-    def ffmpeg_alive(self):
-        if self.ffmpeg_proc is None:
-            return False
-        if self.ffmpeg_proc.poll() is None:
-            return True
-        return False
+    def restarts(self):
+        #  ffmpeg restarts, or reconnects of the native source client
+        return getattr(self.sink, 'restarts', max(getattr(self.sink, 'connects', 1) - 1, 0))
 
     @property
-    def ffmpeg_healthy(self):
-        if self.ffmpeg_alive or self.ffmpeg_proc is None:
-            return True
-        if self.ffmpeg_proc.returncode == 0:
-            logger.debug("ffmpeg returned: %s", self.ffmpeg_proc.returncode)
-            return True
-        return False
+    def buffersize(self):
+        return self.tsqueue.qsize() + 1
 
     @property
     def tslength(self):
@@ -4,10 +4,15 @@ FIPBASEURL = 'https://stream.radiofrance.fr'
 FIPLIST = 'https://stream.radiofrance.fr/fip/fip_hifi.m3u8?id=radiofrance'
 #METAURL = 'https://www.radiofrance.fr/fip/api/live/webradios/fip'
 METAURL = 'https://www.radiofrance.fr/fip/api/live?'
+LIVEURL = 'https://icecast.radiofrance.fr/fip-hifi.aac?id=radiofrance'
 AACRE = re.compile(fr'^{FIPBASEURL}/.*(fip_.*\.ts).*$')
 STRPTIME = "%Y-%m-%dT%H:%M:%SZ"
 BUFFERSIZE = 5
 TSLENGTH = 4
+BITRATE = 192000
+MAXMEMORY = 256
+DLWORKERS = 4
+COMPACTAFTER = 1000
 
 METATEMPLATE = {
     "stationName": "fip",
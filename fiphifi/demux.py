@@ -0,0 +1,141 @@
+import logging
+
+logger = logging.getLogger(__package__+'.demux')
+
+TSPACKET = 188
+TSSYNC = 0x47
+ADTSHEADER = 7
+SAMPLESPERFRAME = 1024
+SAMPLERATES = (96000, 88200, 64000, 48000, 44100, 32000,
+               24000, 22050, 16000, 12000, 11025, 8000, 7350)
+
+
+def is_adts(data, start=0):
+    return len(data) - start >= ADTSHEADER and data[start] == 0xFF and data[start + 1] & 0xF6 == 0xF0
+
+
+def is_ts(data):
+    if len(data) < TSPACKET or data[0] != TSSYNC:
+        return False
+    return len(data) < 2 * TSPACKET or data[TSPACKET] == TSSYNC
+
+
+def adts_length(data, start=0):
+    return ((data[start + 3] & 0x03) << 11) | (data[start + 4] << 3) | (data[start + 5] >> 5)
+
+
+def adts_samplerate(data, start=0):
+    try:
+        return SAMPLERATES[(data[start + 2] >> 2) & 0x0F]
+    except IndexError:
+        return 0
+
+
+def adts_frames(data):
+    '''Split a buffer of ADTS into frames, yielding memoryviews into data and
+       the offset of any trailing partial frame as the final (None, offset).'''
+    _view = memoryview(data)
+    _end = len(_view)
+    _i = 0
+    while _i + ADTSHEADER <= _end:
+        if not is_adts(_view, _i):
+            #  Resync on the next 0xFFF
+            _j = data.find(b'\xff', _i + 1)
+            if _j < 0:
+                _i = _end
+                break
+            logger.debug("Skipped %s bytes of garbage in ADTS stream", _j - _i)
+            _i = _j
+            continue
+        _length = adts_length(_view, _i)
+        if _length < ADTSHEADER:
+            _i += 1
+            continue
+        if _i + _length > _end:
+            break
+        yield _view[_i:_i + _length], _i
+        _i += _length
+    yield None, _i
+
+
+class ADTSDemuxer():
+    '''Pull AAC/ADTS frames out of MPEG-TS (or raw ADTS) segments.
+
+       Packet payloads are gathered as memoryviews and joined once per
+       feed() so the only copy is the elementary stream itself. Partial
+       frames are carried over to the next segment.'''
+
+    def __init__(self):
+        self.pid = None
+        self.samplerate = 0
+        self.frames = 0
+        self._carry = b''
+
+    def feed(self, data):
+        if is_ts(data):
+            _chunks = self._payloads(memoryview(data))
+        elif is_adts(data):
+            _chunks = [memoryview(data)]
+        else:
+            logger.warning("Demuxer got %s bytes that are neither TS nor ADTS", len(data))
+            return
+        if self._carry:
+            _chunks.insert(0, self._carry)
+        _es = b''.join(_chunks)
+        for _frame, _offset in adts_frames(_es):
+            if _frame is None:
+                self._carry = _es[_offset:]
+                break
+            if not self.samplerate:
+                self.samplerate = adts_samplerate(_frame)
+            self.frames += 1
+            yield _frame
+
+    def _payloads(self, view):
+        _chunks = []
+        _pes = False
+        for _i in range(0, len(view) - TSPACKET + 1, TSPACKET):
+            if view[_i] != TSSYNC:
+                logger.warning("Lost TS sync at byte %s", _i)
+                break
+            _pusi = view[_i + 1] & 0x40
+            _pid = ((view[_i + 1] & 0x1F) << 8) | view[_i + 2]
+            _afc = (view[_i + 3] >> 4) & 0x03
+            if not _afc & 0x01:
+                continue
+            _start = _i + 4
+            if _afc & 0x02:
+                _start += 1 + view[_start]
+            _stop = _i + TSPACKET
+            if _start >= _stop:
+                continue
+            if self.pid is None and _pusi and self._audio_pes(view, _start):
+                logger.debug("Demuxing AAC from PID %s", _pid)
+                self.pid = _pid
+            if _pid != self.pid:
+                continue
+            if _pusi:
+                if not self._audio_pes(view, _start):
+                    _pes = False
+                    continue
+                _pes = True
+                _start += 9 + view[_start + 8]
+            if _pes and _start < _stop:
+                _chunks.append(view[_start:_stop])
+        return _chunks
+
+    @staticmethod
+    def _audio_pes(view, start):
+        if len(view) - start < 9:
+            return False
+        return view[start] == 0 and view[start + 1] == 0 and view[start + 2] == 1 \
+            and 0xC0 <= view[start + 3] <= 0xDF
+
+    def reset(self):
+        self._carry = b''
+
+    @property
+    def duration(self):
+        if not self.samplerate:
+            return 0
+        return self.frames * SAMPLESPERFRAME / self.samplerate
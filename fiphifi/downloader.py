@@ -1,69 +1,178 @@
-import os
 import time
+import queue
 import logging
 import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from fiphifi.util import get_tmpdir
+from fiphifi.store import segmentname
+from fiphifi.stations import stationof
+from fiphifi.metrics import Histogram
+from fiphifi.constants import TSLENGTH, BUFFERSIZE, DLWORKERS
 
 logger = logging.getLogger(__package__+'.downloader')
 
 
 class Downloader(threading.Thread):
 
-    def __init__(self, _alive, dlqueue, config):
+    duration = TSLENGTH
+
+    def __init__(self, _alive, dlqueue, config, store, pollers=0):
         threading.Thread.__init__(self)
+        self.name = 'Downloader Thread'
         self._alive = _alive
-        self.dldir = os.path.join(get_tmpdir(config['USEROPTS']), 'ts')
+        self.store = store
         self.dlqueue = dlqueue
-        if not os.path.exists(self.dldir):
-            os.mkdir(self.dldir)
+        self.workers = config['USEROPTS'].getint('DLWORKERS', fallback=DLWORKERS) or 1
+        #  Bounds the number of fetches in flight; the pool never queues more than this
+        self.inflight = threading.BoundedSemaphore(self.workers)
+        #  Shared with the playlist and metadata pollers of every station
         self.session = requests.Session()
+        _adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=self.workers + pollers)
+        self.session.mount('https://', _adapter)
+        self.session.mount('http://', _adapter)
+        #  Per station: the last good segment, to fill in for one that never arrives
+        self.lastts = {}
+        #  Per station: segments fetched, bytes fetched, fetches given up on,
+        #  requests that joined a fetch already in flight, retries, 404s and
+        #  segments the store refused (late duplicates of ones already played)
+        self.stats = collections.defaultdict(lambda: {'fetched': 0, 'bytes': 0, 'failed': 0, 'joined': 0,
+                                                      'retries': 0, 'notfound': 0, 'refused': 0})
+        self.latency = Histogram()
+        #  url -> Event set when the one fetch in flight for it is done
+        self._flights = {}
+        self._flightlock = threading.Lock()
 
     def run(self):
-        while self.alive:
-            if not self.dlqueue.empty():
-                self.dl(self.dlqueue.get())
+        logger.info('Starting %s with %s workers', self.name, self.workers)
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix='Download Worker') as pool:
+            _report = time.time()
+            while self.alive:
+                if time.time() - _report > 60:
+                    self.report()
+                    _report = time.time()
+                try:
+                    url = self.dlqueue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                while not self.inflight.acquire(timeout=1):
+                    if not self.alive:
+                        break
+                else:
+                    pool.submit(self._work, url, time.time() + self.deadline)
+            #  Drop what has not started; running fetches finish before the session closes
+            pool.shutdown(cancel_futures=True)
+        self.session.close()
+        logger.warning("%s ended.", self.name)
+
+    def _work(self, url, deadline):
+        try:
+            self.fetch(url, deadline)
+        except Exception as msg:
+            logger.error("%s worker failed on %s: %s", self.name, url, str(msg))
+        finally:
+            self.inflight.release()
+
+    def fetch(self, url, deadline=None):
+        '''Make sure the segment of `url` is in the store, and say whether it
+           is. Callers asking for a url that is already being fetched wait
+           for that fetch instead of starting another.'''
+        _ts = segmentname(url)
+        with self._flightlock:
+            _flight = self._flights.get(url)
+            if _flight is None:
+                if _ts in self.store:
+                    return True
+                _flight = self._flights[url] = threading.Event()
+                _leader = True
             else:
-                time.sleep(1)
-        logger.warning("Downloader thread ended.")
+                _leader = False
+        if not _leader:
+            self.stats[stationof(_ts)]['joined'] += 1
+            _flight.wait(max((deadline or time.time() + self.deadline) - time.time(), 0))
+            return _ts in self.store
+        try:
+            return self.dl(url, deadline)
+        finally:
+            with self._flightlock:
+                del self._flights[url]
+            _flight.set()
 
-    def dl(self, url):
-        req = self._get_url(url)
-        if req is None:
+    def dl(self, url, deadline=None):
+        _ts = segmentname(url)
+        _stats = self.stats[stationof(_ts)]
+        req = self._get_url(url, deadline or time.time() + self.deadline)
+        if req is None or not req.ok or len(req.content) <= 4096:
+            if req is not None and not req.ok:
+                logger.warning("Bad url %s", url)
+            _stats['failed'] += 1
             return False
-        if not req.ok:
-            logger.warning("Bad url %s", url)
+        if not self.store.put(_ts, req.content):
+            logger.debug('Store refused %s', _ts)
+            _stats['refused'] += 1
             return False
-        _ts = os.path.join(self.dldir, os.path.basename(url.split('?')[0]))
-        with open(_ts, 'wb') as fh:
-            fh.write(req.content)
-        if os.path.getsize(_ts) > 4096:
-            logger.debug('Wrote %s (%0.0f kb)', _ts, os.path.getsize(_ts) / 1024)
-            with open(_ts, 'rb') as fh:
-                self.lastts = fh.read()
-            return True
+        self.lastts[stationof(_ts)] = req.content
+        _stats['fetched'] += 1
+        _stats['bytes'] += len(req.content)
+        logger.debug('Wrote %s (%0.0f kb)', _ts, len(req.content) / 1024)
+        return True
+
+    def report(self):
+        for _station, _stats in list(self.stats.items()):
+            logger.info('%s: %s segments (%0.1f MB), %s failed, %s joined, %s refused', _station,
+                        _stats['fetched'], _stats['bytes'] / 1024 / 1024, _stats['failed'], _stats['joined'],
+                        _stats['refused'])
 
-    def _get_url(self, url):
+    def _get_url(self, url, deadline):
         req = None
-        for _i in range(3, 30, 3):
+        _backoff = 0.25
+        _stats = self.stats[stationof(segmentname(url))]
+        while self.alive:
+            _remains = deadline - time.time()
+            if _remains <= 0:
+                logger.warning("%s missed deadline for %s", self.name, segmentname(url))
+                return None
             try:
-                req = self.session.get(url)
-                if req is not None:
-                    if req.ok:
-                        return req
-                    elif req.status_code == 404:
-                        logger.error("%s not found", url)
-                        return None
-                    else:
-                        logger.warning("Got response code: %s", req.status_code)
-                        time.sleep(_i)
+                _start = time.monotonic()
+                req = self.session.get(url, timeout=min(self.duration, _remains))
+                if req.ok:
+                    self.latency.observe(time.monotonic() - _start)
+                    return req
+                elif req.status_code == 404:
+                    logger.error("%s not found", url)
+                    _stats['notfound'] += 1
+                    return None
+                else:
+                    logger.warning("Got response code: %s", req.status_code)
             except (requests.exceptions.ConnectTimeout,
                     requests.exceptions.ReadTimeout,
                     requests.exceptions.ConnectionError):
                 pass
             logger.warning("Retrying %s", url)
+            _stats['retries'] += 1
+            time.sleep(min(_backoff, max(deadline - time.time(), 0)))
+            _backoff = min(_backoff * 2, self.duration)
         return req
 
+    def metrics(self):
+        for _station, _stats in list(self.stats.items()):
+            _labels = {'station': _station}
+            yield 'fipshift_download_segments_total', _labels, _stats['fetched']
+            yield 'fipshift_download_bytes_total', _labels, _stats['bytes']
+            yield 'fipshift_download_failed_total', _labels, _stats['failed']
+            yield 'fipshift_download_joined_total', _labels, _stats['joined']
+            yield 'fipshift_download_retries_total', _labels, _stats['retries']
+            yield 'fipshift_download_notfound_total', _labels, _stats['notfound']
+            yield 'fipshift_download_refused_total', _labels, _stats['refused']
+        yield 'fipshift_download_seconds', {}, self.latency
+
+    @property
+    def deadline(self):
+        #  A segment that cannot be fetched within a few segment lengths
+        #  is left to the Buffer rather than holding up the pool.
+        return self.duration * BUFFERSIZE
+
     @property
     def alive(self):
         return self._alive.isSet()
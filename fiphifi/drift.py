@@ -0,0 +1,73 @@
+import time
+import logging
+import collections
+from fiphifi.demux import SAMPLESPERFRAME
+
+logger = logging.getLogger(__package__+'.drift')
+
+
+class DriftController():
+    '''Hold the delay by dropping or repeating single AAC frames.
+
+       A frame is 1024 samples (~23 ms), so one adjustment is inaudible
+       in silence and barely audible elsewhere. Adjustments are at least
+       `spacing` frames apart and wait up to `patience` frames for a quiet
+       frame, i.e. one much smaller than the running average.'''
+
+    deadband = 0.2
+    spacing = 43
+    patience = 215
+    quiet = 0.25
+    alpha = 0.01
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.error = 0
+        self.dropped = 0
+        self.repeated = 0
+        self.quieted = 0
+        self._adjustments = collections.deque()
+        self._since = self.spacing
+        self._average = 0
+
+    def correct(self, frames, error, samplerate=44100):
+        '''Return frames with drops (error > 0, too far behind) or repeats
+           (error < 0) applied, never more than the error calls for.'''
+        self.error = error
+        _budget = 0
+        if abs(error) > self.deadband:
+            _budget = int(abs(error) * samplerate / SAMPLESPERFRAME)
+        _out = []
+        for _frame in frames:
+            _n = len(_frame)
+            _quiet = _n < self.quiet * self._average
+            self._average = _n if not self._average else self._average + self.alpha * (_n - self._average)
+            self._since += 1
+            if _budget and self._since >= self.spacing and (_quiet or self._since >= self.patience):
+                _budget -= 1
+                self._since = 0
+                self._adjustments.append(time.monotonic())
+                self.quieted += _quiet
+                if error > 0:
+                    self.dropped += 1
+                    continue
+                self.repeated += 1
+                _out.append(_frame)
+            _out.append(_frame)
+        return _out
+
+    @property
+    def perhour(self):
+        '''Adjustments over the last hour.'''
+        _cutoff = time.monotonic() - 3600
+        while self._adjustments and self._adjustments[0] < _cutoff:
+            self._adjustments.popleft()
+        return len(self._adjustments)
+
+    @property
+    def adjustments(self):
+        return self.dropped + self.repeated
+
+    def __str__(self):
+        return (f'error {self.error:+0.2f}s, {self.perhour} adjustments/h '
+                f'(dropped {self.dropped}, repeated {self.repeated}, {self.quieted} in silence)')
@@ -0,0 +1,50 @@
+import logging
+import configparser
+from fiphifi.options import delayfor
+
+logger = logging.getLogger(__package__+'.fanout')
+
+
+class Output():
+    '''One delayed mount: its own delay, icecast mount and metadata cursor.'''
+
+    def __init__(self, mount, delay, config):
+        self.mount = mount
+        self.delay = delay
+        self.config = configparser.ConfigParser()
+        self.config.read_dict({_section: dict(config.items(_section, raw=True))
+                               for _section in config.sections()})
+        self.config['USEROPTS']['MOUNT'] = mount
+        self.station = None
+        self.playlist = None
+        self.metadata = None
+        self.sender = None
+        self.pusher = None
+        self.vamp = None
+        self.epoch = 0
+        self.last_slug = ''
+        self.last_update = 0
+
+    @property
+    def started(self):
+        return self.sender is not None and self.sender.ident is not None
+
+    def __str__(self):
+        return f'/{self.mount} ({self.station or "fip"}, {self.delay / 3600:0.1f}h)'
+
+
+def outputs(opts, config):
+    '''Every mount to play out. OUTPUTS lists mount=timezone (or seconds)
+       pairs; without it there is just MOUNT at the --timezone delay.'''
+    _c = config['USEROPTS']
+    _outputs = []
+    for _pair in _c.get('OUTPUTS', '').split(','):
+        if not _pair.strip():
+            continue
+        _mount, _, _zone = _pair.strip().partition('=')
+        _outputs.append(Output(_mount.strip().lstrip('/'), delayfor(_zone.strip()), config))
+    if not _outputs:
+        _outputs.append(Output(_c['MOUNT'], opts.delay, config))
+    if len({_output.mount for _output in _outputs}) < len(_outputs):
+        raise ValueError("OUTPUTS lists the same mount twice")
+    return _outputs
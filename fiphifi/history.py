@@ -0,0 +1,64 @@
+import collections
+from fiphifi.util import parsets
+
+
+class SegmentIndex():
+    '''Ordered set of [timestamp, url] history entries keyed on the
+       (prefix, suffix) that parsets() pulls out of the url.
+
+       Membership is a dict lookup and the oldest entries are evicted
+       from the front, so neither depends on the length of the delay.'''
+
+    def __init__(self, entries=()):
+        self._index = collections.OrderedDict()
+        for _entry in entries:
+            self.add(_entry)
+
+    def add(self, entry):
+        _key = tuple(parsets(entry[1]))
+        self._index[_key] = entry
+        return _key
+
+    def evict(self, n):
+        _evicted = []
+        for _ in range(min(n, len(self._index))):
+            _evicted.append(self._index.popitem(last=False)[1])
+        return _evicted
+
+    def keep(self, n):
+        return self.evict(len(self._index) - n)
+
+    def get(self, key, default=None):
+        return self._index.get(key, default)
+
+    @property
+    def first(self):
+        for _entry in self._index.values():
+            return _entry
+        return None
+
+    @property
+    def lastkey(self):
+        if not self._index:
+            return None
+        return next(reversed(self._index))
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index.values())
+
+    def __getitem__(self, i):
+        if i == 0:
+            _entry = self.first
+        elif i == -1 and self._index:
+            _entry = self._index[self.lastkey]
+        else:
+            return list(self._index.values())[i]
+        if _entry is None:
+            raise IndexError('SegmentIndex is empty')
+        return _entry
@@ -0,0 +1,158 @@
+import os
+import math
+import time
+import queue
+import logging
+import threading
+import collections
+from fiphifi.listen import listener
+from fiphifi.store import segmentname
+from fiphifi.buffer import Buffer
+from fiphifi.pipeline import report
+from fiphifi.constants import TSLENGTH, BUFFERSIZE, STRPTIME
+
+logger = logging.getLogger(__package__+'.hls')
+
+
+class HLSStream(threading.Thread):
+    '''Publish a delayed HLS media playlist over the stored segments.
+
+       Nothing is demuxed, paced or encoded: a segment joins the sliding
+       window once it is `delay` old, and listeners pull the playlist and
+       the .ts files from the HTTP listener themselves.'''
+
+    duration = TSLENGTH
+    #  Segments in the playlist, and how many more stay fetchable after
+    #  they slide out of it for clients that are still catching up
+    window = 3 * BUFFERSIZE
+    grace = 2 * BUFFERSIZE
+
+    def __init__(self, _alive, urlqueue, delay, config, store, **kwargs):
+        threading.Thread.__init__(self)
+        self.name = 'HLS Playlist Thread'
+        self._alive = _alive
+        self.urlq = urlqueue
+        self.store = store
+        self.delay = delay
+        _c = config['USEROPTS']
+        self.path = '/' + os.path.splitext(_c['MOUNT'].strip('/'))[0]
+        self.segments = collections.deque()
+        self.retired = collections.deque()
+        #  EXT-X-MEDIA-SEQUENCE of segments[0]
+        self.sequence = 0
+        self.published = 0
+        self.missing = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+        self.server = listener(_c)
+
+    def run(self):
+        logger.info('Starting %s for %s.m3u8', self.name, self.path)
+        if not self.alive:
+            logger.warn("%s called without alive set.", self.name)
+        self.server.publish(self.path, self)
+        _report = time.time()
+        try:
+            while self.alive:
+                if time.time() - _report > 60:
+                    logger.info('%s.m3u8 Offset: %0.0f / Delay: %0.0f / Published: %s (%s missing) / Requests: %s',
+                                self.path, self.offset, self.delay, self.published, self.missing, self.server.pulled)
+                    report()
+                    _report = time.time()
+                try:
+                    _timestamp, _url = self.urlq.get(timeout=self.duration)
+                except queue.Empty:
+                    logger.warning('%s url queue empty.', self.name)
+                    continue
+                self.advance(_timestamp, segmentname(_url))
+        finally:
+            self.server.unpublish(self.path)
+            logger.warning('%s ending.', self.name)
+
+    def advance(self, timestamp, name):
+        if timestamp:
+            while self.alive and time.time() < timestamp + self.delay:
+                time.sleep(min(timestamp + self.delay - time.time(), 1))
+            if time.time() - timestamp - self.delay > Buffer.skipafter:
+                logger.warning("%s skipping %s, %0.0fs past the delay.",
+                               self.name, name, time.time() - timestamp - self.delay)
+                self.store.discard(name)
+                self.skipped += 1
+                return
+        if name not in self.store:
+            #  Leave a gap rather than hold the window: players skip over it
+            logger.warning("%s never got %s, leaving it out.", self.name, name)
+            self.missing += 1
+            return
+        with self.lock:
+            self.segments.append((name, timestamp))
+            self.published += 1
+            while len(self.segments) > self.window:
+                self.retired.append(self.segments.popleft())
+                self.sequence += 1
+            while len(self.retired) > self.grace:
+                self.store.discard(self.retired.popleft()[0])
+
+    def m3u8(self):
+        '''The media playlist as it stands, or None before the delay is up.'''
+        with self.lock:
+            _segments = list(self.segments)
+            _sequence = self.sequence
+        if not _segments:
+            return None
+        _base = os.path.basename(self.path)
+        _lines = ['#EXTM3U',
+                  '#EXT-X-VERSION:3',
+                  f'#EXT-X-TARGETDURATION:{math.ceil(self.duration)}',
+                  f'#EXT-X-MEDIA-SEQUENCE:{_sequence}']
+        for _name, _timestamp in _segments:
+            if _timestamp:
+                _lines.append('#EXT-X-PROGRAM-DATE-TIME:' + time.strftime(STRPTIME, time.gmtime(_timestamp + self.delay)))
+            _lines.append(f'#EXTINF:{self.duration:0.3f},')
+            _lines.append(f'{_base}/{_name}')
+        return ('\n'.join(_lines) + '\n').encode()
+
+    def segment(self, name):
+        '''(fd, offset, length) to sendfile() or the bytes of a segment that
+           is (or just was) in the window; None for anything else.'''
+        with self.lock:
+            if not any(_name == name for _name, _ in self.segments) and \
+               not any(_name == name for _name, _ in self.retired):
+                return None
+        _open = getattr(self.store, 'open', None)
+        if _open is not None:
+            return _open(name)
+        _data = self.store.get(name)
+        return None if _data is None else bytes(_data)
+
+    def metrics(self):
+        _labels = {'mount': self.path.lstrip('/') + '.m3u8'}
+        if self.segments:
+            yield 'fipshift_playout_offset_seconds', _labels, self.offset
+            yield 'fipshift_playout_delta_seconds', _labels, self.delta
+        yield 'fipshift_playout_skipped_total', _labels, self.skipped
+        yield 'fipshift_playout_garbage_total', _labels, self.missing
+
+    @property
+    def alive(self):
+        return self._alive.isSet()
+
+    @property
+    def timestamp(self):
+        '''Source timestamp of the newest segment in the window.'''
+        with self.lock:
+            if not self.segments:
+                return 0
+            return float(self.segments[-1][1])
+
+    @property
+    def offset(self):
+        return time.time() - self.timestamp
+
+    @property
+    def delta(self):
+        return self.offset - self.delay
+
+    @property
+    def listeners(self):
+        return self.server.listeners
@@ -0,0 +1,227 @@
+import time
+import socket
+import subprocess
+import base64
+import logging
+import threading
+import collections
+import requests
+from fiphifi.demux import is_adts
+from fiphifi.constants import LIVEURL
+
+logger = logging.getLogger(__package__+'.icecast')
+
+
+class IcecastSource():
+    '''Persistent source connection to one Icecast mount.
+
+       Data handed to write() is kept in a bounded backlog until the
+       socket accepts it. A dropped connection is re-established in the
+       background, so write() never waits on a dead server, and the new
+       connection starts at the next ADTS frame in the backlog.'''
+
+    timeout = 5
+    backoff = (0.05, 5)
+    backlog = 1048576
+    chunksize = 16384
+
+    def __init__(self, _c, content_type='audio/aac'):
+        self.host = _c['HOST']
+        self.port = int(_c['PORT'])
+        self.mount = '/' + _c['MOUNT'].lstrip('/')
+        _auth = base64.b64encode(f"{_c['USER']}:{_c['PASSWORD']}".encode()).decode()
+        self.headers = {'Host': f'{self.host}:{self.port}',
+                        'Authorization': f'Basic {_auth}',
+                        'User-Agent': 'fipshift',
+                        'Content-Type': content_type,
+                        'Ice-Name': _c.get('NAME', 'FipShift'),
+                        'Ice-Description': 'Time-shifted FIP stream',
+                        'Ice-Genre': _c.get('GENRE', 'Eclectic'),
+                        'Ice-Url': _c.get('URL', ''),
+                        'Ice-Public': _c.get('PUBLIC', '0'),
+                        'Expect': '100-continue'}
+        self.sock = None
+        self.lock = threading.Lock()
+        self._backlog = collections.deque()
+        self._pending = 0
+        self._offset = 0
+        self._retry_at = 0
+        self._delay = self.backoff[0]
+        self._connecting = None
+        #  Bumped by close(), so a connection that lands afterwards is not kept
+        self._generation = 0
+        self.connects = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def _open(self):
+        _sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        try:
+            _sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            _head = ''.join(f'{_k}: {_v}\r\n' for _k, _v in self.headers.items())
+            _sock.sendall(f'PUT {self.mount} HTTP/1.1\r\n{_head}\r\n'.encode())
+            _status = self._status(_sock)
+            if _status not in (100, 200):
+                raise ConnectionError(f'Icecast refused {self.mount} ({_status})')
+        except (OSError, ConnectionError):
+            _sock.close()
+            raise
+        return _sock
+
+    def _connect(self, generation):
+        try:
+            _sock = self._open()
+        except (OSError, ConnectionError) as msg:
+            logger.warning("Could not connect to icecast: %s", msg)
+            with self.lock:
+                self._retry_at = time.monotonic() + self._delay
+                self._delay = min(self._delay * 2, self.backoff[1])
+                self._connecting = None
+            return
+        with self.lock:
+            self._connecting = None
+            if generation != self._generation:
+                _sock.close()
+                return
+            self._delay = self.backoff[0]
+            self.sock = _sock
+            self.connects += 1
+            self._resync()
+        logger.info("%s to %s:%s%s", 'Reconnected' if self.connects > 1 else 'Connected',
+                    self.host, self.port, self.mount)
+
+    def _resync(self):
+        '''Skip to the first ADTS frame header left in the backlog, so a
+           new connection never starts mid-frame.'''
+        while self._backlog:
+            _chunk = self._backlog[0]
+            for _i in range(self._offset, len(_chunk)):
+                if is_adts(_chunk, _i):
+                    self.dropped += _i - self._offset
+                    self._offset = _i
+                    return
+            self._backlog.popleft()
+            self._pending -= len(_chunk)
+            self.dropped += len(_chunk) - self._offset
+            self._offset = 0
+
+    @staticmethod
+    def _status(_sock):
+        _resp = b''
+        while b'\r\n\r\n' not in _resp:
+            _chunk = _sock.recv(1024)
+            if not _chunk:
+                break
+            _resp += _chunk
+        try:
+            return int(_resp.split(b'\r\n')[0].split()[1])
+        except (IndexError, ValueError):
+            logger.warning("Garbled response from icecast: %s", _resp[:80])
+            return 0
+
+    def write(self, data):
+        with self.lock:
+            self._backlog.append(bytes(data))
+            self._pending += len(data)
+            while self._pending > self.backlog and len(self._backlog) > 1:
+                _old = self._backlog.popleft()
+                self._pending -= len(_old)
+                self.dropped += len(_old) - self._offset
+                self._offset = 0
+            self._flush()
+        return len(data)
+
+    def _flush(self):
+        if self.sock is None:
+            if self._connecting is None and time.monotonic() >= self._retry_at:
+                self._connecting = threading.Thread(target=self._connect, args=(self._generation,),
+                                                    daemon=True, name=f'Icecast Connect {self.mount}')
+                self._connecting.start()
+            return
+        while self._backlog:
+            _view = memoryview(self._backlog[0])
+            try:
+                while self._offset < len(_view):
+                    self._offset += self.sock.send(_view[self._offset:self._offset + self.chunksize])
+            except OSError as msg:
+                logger.warning("Lost connection to icecast: %s", msg)
+                self._close()
+                return
+            self._backlog.popleft()
+            self._pending -= self._offset
+            self.sent += self._offset
+            self._offset = 0
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def close(self):
+        with self.lock:
+            self._generation += 1
+            self._close()
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    @property
+    def pending(self):
+        return self._pending
+
+
+class IcecastRelay(threading.Thread):
+    '''Relay the live FIP stream to icecast while the buffer fills.
+       Quacks like the ffmpeg Popen it replaces.'''
+
+    chunksize = 4096
+    timeout = IcecastSource.timeout
+
+    def __init__(self, _c, url=LIVEURL, sink=None):
+        threading.Thread.__init__(self)
+        self.name = 'Icecast Relay Thread'
+        self.url = url
+        self.source = sink if sink is not None else IcecastSource(_c)
+        self.returncode = None
+        self._halt = threading.Event()
+
+    def run(self):
+        session = requests.Session()
+        while not self._halt.is_set():
+            try:
+                with session.get(self.url, stream=True, timeout=self.timeout) as req:
+                    req.raise_for_status()
+                    for _chunk in req.iter_content(self.chunksize):
+                        if self._halt.is_set():
+                            break
+                        self.source.write(_chunk)
+            except requests.exceptions.RequestException as msg:
+                logger.warning("%s lost live stream: %s", self.name, msg)
+                self._halt.wait(1)
+        session.close()
+        self.source.close()
+        self.returncode = 0
+
+    def poll(self):
+        if self.is_alive():
+            return None
+        return self.returncode if self.returncode is not None else 1
+
+    def wait(self, timeout=None):
+        '''Join the relay; once this returns its source is closed.'''
+        self.join(timeout)
+        if self.is_alive():
+            raise subprocess.TimeoutExpired(self.name, timeout)
+        return self.returncode
+
+    def terminate(self):
+        self._halt.set()
+
+    def kill(self):
+        #  Let go of the mount even if the live stream read is stuck
+        self._halt.set()
+        self.source.close()
@@ -0,0 +1,371 @@
+import os
+import socket
+import logging
+import threading
+import selectors
+import collections
+from fiphifi.util import get_tmpdir
+from fiphifi.demux import is_adts
+
+logger = logging.getLogger(__package__+'.listen')
+
+#  One listener per host:port, shared by every mount that plays on it
+_listeners = {}
+_lock = threading.Lock()
+
+
+class ADTSRing():
+    '''The paced ADTS stream of one mount in a fixed-size file.
+
+       Listeners keep an absolute byte offset into it and are served
+       with sendfile(), so the bytes never pass through Python. `marks`
+       holds recent offsets where an ADTS frame starts, to (re)join on.'''
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.ftruncate(self.fd, size)
+        self.written = 0
+        self.marks = collections.deque(maxlen=4096)
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        _n = len(data)
+        if _n > self.size:
+            data = data[_n - self.size:]
+        with self.lock:
+            if self.fd is None:
+                return _n
+            for _i in range(min(len(data), 4096)):
+                if is_adts(data, _i):
+                    self.marks.append(self.written + _i)
+                    break
+            _pos = self.written % self.size
+            _first = min(len(data), self.size - _pos)
+            os.pwrite(self.fd, data[:_first], _pos)
+            if _first < len(data):
+                os.pwrite(self.fd, data[_first:], 0)
+            self.written += _n
+        return _n
+
+    def mark(self, behind):
+        '''Newest frame start at least `behind` bytes back from the head.'''
+        with self.lock:
+            _oldest = self.written - self.size
+            _mark = None
+            for _offset in reversed(self.marks):
+                if _offset <= _oldest:
+                    break
+                _mark = _offset
+                if self.written - _offset >= behind:
+                    break
+            return self.written if _mark is None else _mark
+
+    def sendfile(self, sock, offset, limit):
+        with self.lock:
+            _n = min(self.written - offset, limit)
+        _pos = offset % self.size
+        _n = min(_n, self.size - _pos)
+        if _n <= 0:
+            return 0
+        return os.sendfile(sock.fileno(), self.fd, _pos, _n)
+
+    def close(self):
+        with self.lock:
+            if self.fd is None:
+                return
+            os.close(self.fd)
+            self.fd = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _Client():
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.request = b''
+        self.pending = b''
+        self.ring = None
+        self.offset = 0
+        self.idle = False
+        #  [fd, offset, end] of a segment being sent whole
+        self.file = None
+
+
+class HTTPListener(threading.Thread):
+    '''Serve each mount's ADTSRing to plain HTTP listeners from one thread.
+
+       Everyone on a mount follows the same playout; a listener that falls
+       more than `backlog` bytes behind is moved up to the newest frames
+       instead of holding anything else up. Published HLS playlists are
+       served at <path>.m3u8 with their segments under <path>/.'''
+
+    backlog = 262144
+    preroll = 16384
+    chunksize = 65536
+    ringsize = 4 * backlog
+
+    def __init__(self, host, port, tmpdir):
+        threading.Thread.__init__(self)
+        self.name = f'HTTP Listener {host}:{port}'
+        self.daemon = True
+        self.tmpdir = tmpdir
+        self.mounts = {}
+        self.playlists = {}
+        self.selector = selectors.DefaultSelector()
+        self.sock = socket.create_server((host, port), reuse_port=False)
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+        self.selector.register(self._wakeup, selectors.EVENT_READ, None)
+        self.clients = set()
+        #  Clients on a mount; only the listener thread changes it, so others can read it
+        self._listening = 0
+        self._halt = threading.Event()
+        self.served = 0
+        self.skipped = 0
+        self.pulled = 0
+
+    def mount(self, mount):
+        with _lock:
+            if mount not in self.mounts:
+                _path = os.path.join(self.tmpdir, f"http-{mount.strip('/').replace('/', '_')}.adts")
+                self.mounts[mount] = ADTSRing(_path, self.ringsize)
+                logger.info("Serving %s on %s", mount, self.name)
+            return self.mounts[mount]
+
+    def publish(self, path, playlist):
+        with _lock:
+            self.playlists[path] = playlist
+        logger.info("Serving %s.m3u8 on %s", path, self.name)
+
+    def unpublish(self, path):
+        with _lock:
+            self.playlists.pop(path, None)
+
+    def wake(self):
+        try:
+            self._waker.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def run(self):
+        while not self._halt.is_set():
+            for _key, _events in self.selector.select(timeout=1):
+                if _key.fileobj is self.sock:
+                    self._accept()
+                elif _key.fileobj is self._wakeup:
+                    self._wake()
+                elif _key.data not in self.clients:
+                    continue
+                elif _events & selectors.EVENT_WRITE:
+                    self._send(_key.data)
+                else:
+                    self._read(_key.data)
+        for _client in list(self.clients):
+            self._drop(_client)
+        with _lock:
+            for _ring in self.mounts.values():
+                _ring.close()
+        self.selector.close()
+        self.sock.close()
+        self._wakeup.close()
+        self._waker.close()
+        logger.info("%s closed.", self.name)
+
+    def close(self):
+        '''Hang up on everyone and remove the mounts' ring files.'''
+        self._halt.set()
+        self.wake()
+        self.join(timeout=5)
+
+    def _accept(self):
+        try:
+            _sock, _addr = self.sock.accept()
+        except BlockingIOError:
+            return
+        _sock.setblocking(False)
+        #  Keep the kernel from buffering more than we would for a slow listener
+        _sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.chunksize)
+        _client = _Client(_sock, _addr)
+        self.clients.add(_client)
+        self.selector.register(_sock, selectors.EVENT_READ, _client)
+
+    def _wake(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        for _client in self.clients:
+            if _client.idle:
+                _client.idle = False
+                self.selector.modify(_client.sock, selectors.EVENT_WRITE, _client)
+
+    def _read(self, client):
+        try:
+            _data = client.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            _data = b''
+        if not _data:
+            self._drop(client)
+            return
+        if client.ring is not None:
+            return
+        client.request += _data
+        if b'\r\n\r\n' not in client.request:
+            if len(client.request) > 8192:
+                self._drop(client)
+            return
+        try:
+            _method, _path = client.request.split(b'\r\n', 1)[0].split()[:2]
+            _mount = _path.decode().split('?')[0]
+        except (ValueError, UnicodeDecodeError):
+            _method, _mount = b'', ''
+        client.ring = self.mounts.get(_mount)
+        if _method == b'GET' and client.ring is None:
+            self._pull(client, _mount)
+        elif _method != b'GET' or client.ring is None:
+            client.pending = b'HTTP/1.0 404 Not Found\r\nConnection: close\r\n\r\n'
+            client.ring = None
+        else:
+            client.pending = (b'HTTP/1.0 200 OK\r\n'
+                              b'Content-Type: audio/aac\r\n'
+                              b'Cache-Control: no-cache\r\n'
+                              b'Connection: close\r\n\r\n')
+            client.offset = client.ring.mark(self.preroll)
+            self._listening += 1
+            self.served += 1
+            logger.info("Listener %s:%s on %s (%s connected)", *client.addr[:2], _mount, len(self.clients))
+        self.selector.modify(client.sock, selectors.EVENT_WRITE, client)
+
+    def _pull(self, client, path):
+        '''Answer a request for an HLS playlist or one of its segments.'''
+        _dir, _, _name = path.rpartition('/')
+        _body = None
+        if path.endswith('.m3u8') and path[:-5] in self.playlists:
+            _body = self.playlists[path[:-5]].m3u8()
+            _type = b'application/vnd.apple.mpegurl'
+            _status = b'503 Service Unavailable' if _body is None else b'200 OK'
+        elif _dir in self.playlists:
+            _body = self.playlists[_dir].segment(_name)
+            _type = b'video/mp2t'
+            _status = b'404 Not Found' if _body is None else b'200 OK'
+        else:
+            _status = b'404 Not Found'
+        if _body is None:
+            client.pending = b'HTTP/1.0 ' + _status + b'\r\nConnection: close\r\n\r\n'
+            return
+        if isinstance(_body, tuple):
+            _fd, _offset, _n = _body
+            client.file = [_fd, _offset, _offset + _n]
+            _body = b''
+        else:
+            _n = len(_body)
+        client.pending = (b'HTTP/1.0 200 OK\r\n'
+                          b'Content-Type: ' + _type + b'\r\n'
+                          b'Content-Length: ' + str(_n).encode() + b'\r\n'
+                          b'Cache-Control: no-cache\r\n'
+                          b'Connection: close\r\n\r\n') + _body
+        self.pulled += 1
+
+    def _send(self, client):
+        try:
+            if client.pending:
+                client.pending = client.pending[client.sock.send(client.pending):]
+                if client.pending or client.ring is not None or client.file is not None:
+                    return
+                self._drop(client)
+                return
+            if client.file is not None:
+                _fd, _offset, _end = client.file
+                _sent = os.sendfile(client.sock.fileno(), _fd, _offset, min(_end - _offset, self.chunksize))
+                client.file[1] += _sent
+                if not _sent or client.file[1] >= _end:
+                    self._drop(client)
+                return
+            if client.ring.written - client.offset > self.backlog:
+                client.offset = client.ring.mark(self.preroll)
+                self.skipped += 1
+                logger.debug("Listener %s:%s fell behind, skipping ahead.", *client.addr[:2])
+            _sent = client.ring.sendfile(client.sock, client.offset, self.chunksize)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._drop(client)
+            return
+        client.offset += _sent
+        if client.offset >= client.ring.written:
+            #  Caught up: wait for the next write (or a hang-up)
+            client.idle = True
+            self.selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def _drop(self, client):
+        if client not in self.clients:
+            return
+        self.clients.discard(client)
+        if client.ring is not None:
+            self._listening -= 1
+        if client.file is not None:
+            os.close(client.file[0])
+            client.file = None
+        try:
+            self.selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+
+    @property
+    def listeners(self):
+        return self._listening
+
+
+def listener(_c):
+    _host = _c.get('LISTENHOST', '0.0.0.0')
+    _port = _c.getint('LISTENPORT', fallback=8080)
+    with _lock:
+        if (_host, _port) not in _listeners:
+            _listener = HTTPListener(_host, _port, get_tmpdir(_c))
+            _listener.start()
+            _listeners[(_host, _port)] = _listener
+        return _listeners[(_host, _port)]
+
+
+def closelisteners():
+    with _lock:
+        _closing = list(_listeners.values())
+        _listeners.clear()
+    for _listener in _closing:
+        _listener.close()
+
+
+class HTTPSink():
+    '''Playout sink for PLAYOUT=http. Never blocks: slow listeners are
+       the listener's problem, not the pacer's.'''
+
+    def __init__(self, _c):
+        self.server = listener(_c)
+        self.ring = self.server.mount('/' + _c['MOUNT'].lstrip('/'))
+
+    def write(self, data):
+        _n = self.ring.write(data)
+        self.server.wake()
+        return _n
+
+    def close(self):
+        #  The ring outlives any one writer: the vamp relay hands over to
+        #  playout. closelisteners() removes it at shutdown.
+        pass
+
+    @property
+    def listeners(self):
+        return self.server.listeners
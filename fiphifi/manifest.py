@@ -0,0 +1,201 @@
+import os
+import json
+import zlib
+import time
+import logging
+import threading
+import collections
+from fiphifi.util import appendcache, writecache
+from fiphifi.constants import COMPACTAFTER, TSLENGTH
+
+logger = logging.getLogger(__package__+'.manifest')
+
+MANIFEST = 'manifest.jsonl'
+
+
+class ManifestStore():
+    '''A segment store that journals what it holds, so a restart can play
+       the segments still on disk instead of buffering the delay again.
+
+       Every put() appends the segment's name, size, crc32 and location
+       (the ring offset, if any) and every discard() a tombstone, fsynced
+       like the url cache. restore() replays the journal and keeps only
+       the segments whose bytes still check out.
+
+       Entries are kept in the order they were stored, so the oldest ones
+       are always at the front for the Collector.'''
+
+    #  Recently discarded names: a put() for one of them is a late
+    #  duplicate of a segment that has already been played
+    tombstones = 4096
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._discarded = collections.OrderedDict()
+        self._journaled = None
+        self.duplicates = 0
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def put(self, name, data):
+        with self.lock:
+            if name in self._discarded:
+                self.duplicates += 1
+                logger.debug("%s was already played, not storing it again.", name)
+                return False
+        if not self.store.put(name, data):
+            return False
+        _entry = {'put': name, 'size': len(data), 'crc': zlib.crc32(data), 'time': int(time.time())}
+        _locate = getattr(self.store, 'locate', None)
+        if _locate is not None:
+            _entry['at'] = (_locate(name) or (None,))[0]
+        with self.lock:
+            self._forget(name)
+            self._entries[name] = _entry
+            self.used += _entry['size']
+            self._journal([_entry])
+        return True
+
+    def discard(self, name):
+        self.store.discard(name)
+        with self.lock:
+            self._discarded[name] = None
+            if len(self._discarded) > self.tombstones:
+                self._discarded.popitem(last=False)
+            if self._forget(name):
+                self._journal([{'discard': name}])
+
+    def _forget(self, name):
+        _entry = self._entries.pop(name, None)
+        if _entry is None:
+            return False
+        self.used -= _entry['size']
+        return True
+
+    def expired(self, before, batch):
+        '''Up to `batch` of the oldest names stored before `before`.'''
+        _names = []
+        with self.lock:
+            for _name, _entry in self._entries.items():
+                if len(_names) >= batch or _entry.get('time', before) >= before:
+                    break
+                _names.append(_name)
+        return _names
+
+    def _journal(self, lines):
+        if self._journaled is None or self._journaled > 2 * len(self._entries) + COMPACTAFTER:
+            writecache(self.path, self._entries.values())
+            self._journaled = len(self._entries)
+        else:
+            appendcache(self.path, lines)
+            self._journaled += len(lines)
+
+    def restore(self):
+        '''Replay the journal and return the names of the segments that
+           survived; anything torn, overwritten or unlisted is dropped.'''
+        _entries = collections.OrderedDict()
+        if os.path.exists(self.path):
+            with open(self.path) as fh:
+                for _line in fh:
+                    try:
+                        _entry = json.loads(_line)
+                    except json.JSONDecodeError:
+                        continue
+                    if 'discard' in _entry:
+                        _entries.pop(_entry['discard'], None)
+                    elif 'put' in _entry:
+                        _entry.setdefault('time', int(time.time()))
+                        _entries.pop(_entry['put'], None)
+                        _entries[_entry['put']] = _entry
+        _adopt = getattr(self.store, 'adopt', None)
+        if _adopt is not None:
+            for _name, _entry in _entries.items():
+                if _entry.get('at') is not None:
+                    _adopt(_name, _entry['at'], _entry['size'])
+        _dropped = 0
+        for _name, _entry in list(_entries.items()):
+            _data = self.store.get(_name)
+            if _data is None or len(_data) != _entry['size'] or zlib.crc32(_data) != _entry['crc']:
+                self.store.discard(_name)
+                del _entries[_name]
+                _dropped += 1
+        _names = getattr(self.store, 'names', None)
+        if _names is not None:
+            for _name in _names():
+                if _name not in _entries:
+                    self.store.discard(_name)
+                    _dropped += 1
+        with self.lock:
+            self._entries = _entries
+            self.used = sum(_entry['size'] for _entry in _entries.values())
+            writecache(self.path, self._entries.values())
+            self._journaled = len(self._entries)
+        logger.info("Restored %s segments from %s (dropped %s).", len(_entries), self.path, _dropped)
+        return set(_entries)
+
+    def get(self, name):
+        return self.store.get(name)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def metrics(self):
+        yield 'fipshift_store_bytes', {}, self.used
+        yield 'fipshift_store_segments', {}, len(self._entries)
+
+    def close(self):
+        self.store.close()
+
+    def __contains__(self, name):
+        return name in self.store
+
+    def __getattr__(self, attr):
+        return getattr(self.store, attr)
+
+
+class Collector(threading.Thread):
+    '''Discard segments that no playout will ever ask for.
+
+       Playouts discard what they play, but late downloads, fillers and
+       segments skipped before they arrived would otherwise sit on disk
+       until the next restart. Anything stored more than `maxage` ago is
+       past every delay, and is collected a small batch at a time. The
+       SharedStores in `shared` forget what their readers never released.'''
+
+    batch = 32
+    interval = TSLENGTH
+
+    def __init__(self, _alive, store, maxage, shared=()):
+        threading.Thread.__init__(self)
+        self.name = 'Collector Thread'
+        self.daemon = True
+        self._alive = _alive
+        self.store = store
+        self.maxage = maxage
+        self.shared = list(shared)
+        self.collected = 0
+
+    def run(self):
+        logger.info('Starting %s (collecting after %0.1fh)', self.name, self.maxage / 3600)
+        _report = time.time()
+        while self.alive:
+            time.sleep(self.interval)
+            _names = self.store.expired(time.time() - self.maxage, self.batch)
+            for _name in _names:
+                self.store.discard(_name)
+                for _shared in self.shared:
+                    _shared.forget(_name)
+            if _names:
+                self.collected += len(_names)
+                logger.debug('%s collected %s segments.', self.name, len(_names))
+            if time.time() - _report > 60:
+                logger.info('Store: %s segments (%0.0f MB), %s collected, %s late duplicates',
+                            len(self.store), self.store.used / 1024 / 1024, self.collected, self.store.duplicates)
+                _report = time.time()
+        logger.warning('%s ended (alive: %s)', self.name, self.alive)
+
+    @property
+    def alive(self):
+        return self._alive.isSet()
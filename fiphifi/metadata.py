@@ -1,21 +1,23 @@
 import os
+import bisect
 import threading
 import time
 import json
 import logging
 import requests  # type: ignore
 from fiphifi.constants import METAURL, METATEMPLATE  # type: ignore
+from fiphifi.metrics import Histogram
 
 logger = logging.getLogger(__package__+'.metadata')
 
 
-def send_metadata(url, mount, slug, auth):
+def send_metadata(url, mount, slug, auth, session=requests, timeout=(2, 5)):
     _params = {'mode': 'updinfo',
                'mount': f"/{mount}",
                'song': slug}
     try:
-        req = requests.get(f'http://{url}/admin/metadata', params=_params,
-                           auth=requests.auth.HTTPBasicAuth(*auth))
+        req = session.get(f'http://{url}/admin/metadata', params=_params,
+                          auth=requests.auth.HTTPBasicAuth(*auth), timeout=timeout)
         if 'Metadata update successful' in req.text:
             logger.info('Metadata udpate: %s', slug)
             return True
@@ -26,30 +28,125 @@ def send_metadata(url, mount, slug, auth):
             requests.exceptions.ReadTimeout,
             requests.exceptions.ConnectionError):
         logger.warning('Metadata update failed to communicate with icecast.')
+    return False
+
+
+class MetadataPusher(threading.Thread):
+    '''Send title updates to icecast off the main thread.
+
+       push() never blocks: it replaces whatever is pending, so only the
+       newest title goes out. Failed updates are retried until a newer
+       one arrives.'''
+
+    retry = 5
+
+    def __init__(self, _alive, _c):
+        threading.Thread.__init__(self)
+        self.name = 'Metadata Pusher Thread'
+        self._alive = _alive
+        self.url = f"{_c['HOST']}:{_c['PORT']}"
+        self.mount = _c['MOUNT']
+        self.auth = (_c['USER'], _c['PASSWORD'])
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = None
+        self.last_slug = None
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.latency = Histogram()
+
+    def push(self, slug):
+        with self._lock:
+            if self._pending is not None:
+                self.coalesced += 1
+            self._pending = slug
+        self._wake.set()
+
+    def run(self):
+        logger.info("Starting %s", self.name)
+        _report = time.time()
+        while self.alive:
+            if time.time() - _report > 60:
+                self.report()
+                _report = time.time()
+            if not self._wake.wait(timeout=1):
+                continue
+            self._wake.clear()
+            with self._lock:
+                _slug, self._pending = self._pending, None
+            if _slug is None or _slug == self.last_slug:
+                continue
+            _start = time.monotonic()
+            _ok = send_metadata(self.url, self.mount, _slug, self.auth, session=self.session)
+            self.latency.observe(time.monotonic() - _start)
+            if _ok:
+                self.sent += 1
+                self.last_slug = _slug
+                continue
+            self.failed += 1
+            with self._lock:
+                if self._pending is None:
+                    self._pending = _slug
+            _timer = threading.Timer(self.retry, self._wake.set)
+            _timer.daemon = True
+            _timer.start()
+        self.session.close()
+        logger.warning('%s ended (alive: %s)', self.name, self.alive)
+
+    def report(self):
+        _n = sum(self.latency.counts)
+        logger.info('Titles for /%s: %s sent, %s failed, %s coalesced, %0.2fs mean push',
+                    self.mount, self.sent, self.failed, self.coalesced, self.latency.sum / _n if _n else 0)
+
+    def metrics(self):
+        _labels = {'mount': self.mount}
+        yield 'fipshift_metadata_push_seconds', _labels, self.latency
+        yield 'fipshift_metadata_pushes_total', _labels, self.sent
+        yield 'fipshift_metadata_push_failed_total', _labels, self.failed
+        yield 'fipshift_metadata_push_coalesced_total', _labels, self.coalesced
+
+    @property
+    def alive(self):
+        return self._alive.isSet()
 
 
 class FIPMetadata(threading.Thread):
 
     metadata = METATEMPLATE
     metaurl = METAURL
+    snapshot = 300
 
-    def __init__(self, _alive, tmpdir):
+    def __init__(self, _alive, tmpdir, delay=21600, station=None, session=requests):
         threading.Thread.__init__(self)
         self.name = 'Metadata Thread'
         self._alive = _alive
         self._lock = threading.Lock()
         self._cache = os.path.join(tmpdir, 'metadata.json')
+        self.session = session
+        if station is not None:
+            self.metaurl = station.metaurl
+        if station is not None and station.slug != 'fip':
+            self.name = f'Metadata {station} Thread'
+            self._cache = os.path.join(tmpdir, f'metadata-{station}.json')
+        self.station = station
+        self.delay = delay
         self.last_update = time.time()
+        self.last_snapshot = 0
+        self.fetchtime = Histogram()
+        self.errors = 0
+        #  Track intervals sorted by startTime: _starts[i] -> _intervals[_starts[i]]
+        self._starts = []
+        self._intervals = {}
 
     def run(self):
         logger.info(f"Starting {self.name}")
-        if not os.path.exists(self.cache):
-            with open(self.cache, 'wt') as fh:
-                json.dump({}, fh)
         if not self.alive:
             logger.warn("%s called without alive set.", self.name)
+        self.jsoncache = self._readfromdisk()
         self._updatemetadata()
-        self._writetodisk()
+        self._record()
         while self.alive:
             if time.time() - self.last_update > 300:
                 logger.debug('%s: Forcing update.', self.name)
@@ -57,11 +154,12 @@ class FIPMetadata(threading.Thread):
                 time.sleep(1)
                 continue
             _delay = self._updatemetadata()
-            self._writetodisk()
-            logger.debug("%s wrote %s", self.name, self.current)
+            self._record()
+            logger.debug("%s recorded %s", self.name, self.current)
             for _ in range(_delay):
                 if self.alive:
                     time.sleep(1)
+        self._writetodisk()
         logger.warning('%s ended (alive: %s)', self.name, self.alive)
 
     def _updatemetadata(self):
@@ -69,50 +167,100 @@ class FIPMetadata(threading.Thread):
             return 300000
         logger.info("%s fetching metadata from Fip", self.name)
         self.last_update = time.time()
+        _start = time.monotonic()
         try:
             _json = {}
-            _r = requests.get(self.metaurl, timeout=5)
+            _r = self.session.get(self.metaurl, timeout=5)
+            self.fetchtime.observe(time.monotonic() - _start)
             if _r.status_code != 200:
                 logger.warning('%s error fetching metadata: %s', self.name, _r.status_code)
+                self.errors += 1
                 return 5
             else:
                 _json = _r.json()
-            if _json.get('now', {'endTime': None})['endTime'] is None:
-                logger.debug('%s le nonsense endTime.', self.name)
-                return 5
         except json.JSONDecodeError:
             logger.error("%s JSON error fetching metadata from Fip.", self.name)
+            self.errors += 1
             return 5
         except requests.exceptions.ReadTimeout:
             logger.error("%s: GET request timed out.", self.name)
+            self.errors += 1
             return 5
         except requests.exceptions.ConnectionError:
             logger.error("%s: ConnectionError.", self.name)
+            self.errors += 1
+            return 5
+        return self._ingest(_json)
+
+    def metrics(self):
+        _labels = {'station': self.station.slug if self.station is not None else 'fip'}
+        yield 'fipshift_metadata_fetch_seconds', _labels, self.fetchtime
+        yield 'fipshift_metadata_errors_total', _labels, self.errors
+
+    def _ingest(self, _json):
+        if _json.get('now', {'endTime': None})['endTime'] is None:
+            logger.debug('%s le nonsense endTime.', self.name)
             return 5
         self.metadata = _json
         return int(_json.get('delayToRefresh', 300000) / 1000)
 
-    def _writetodisk(self):
-        _json = self._readfromdisk()
+    def _record(self):
+        _current, _next = self.current, self.next
         with self.lock:
-            _metadata = self.current
-            _now = int(_metadata['startTime'])
-            _json[_now] = _metadata
-            _metadata = self.next
-            _next = int(_metadata['startTime'])
-            if _next not in _json:
-                _json[_next] = _metadata
-            with open(self.cache, 'wt') as fh:
-                json.dump(_json, fh)
+            self._insert(_current, replace=True)
+            self._insert(_next, replace=False)
+            self._evict(time.time() - self.delay - 3600)
+        if time.time() - self.last_snapshot > self.snapshot:
+            self._writetodisk()
+
+    def _insert(self, metadata, replace):
+        _start = int(metadata['startTime'])
+        if _start not in self._intervals:
+            bisect.insort(self._starts, _start)
+        elif not replace:
+            return
+        self._intervals[_start] = metadata
+
+    def _evict(self, until):
+        _n = 0
+        while _n < len(self._starts) and self._intervals[self._starts[_n]]['endTime'] < until:
+            del self._intervals[self._starts[_n]]
+            _n += 1
+        del self._starts[:_n]
+
+    def lookup(self, when):
+        with self.lock:
+            _i = bisect.bisect_right(self._starts, int(when)) - 1
+            if _i < 0:
+                return {}
+            _metadata = self._intervals[self._starts[_i]]
+            if int(_metadata['endTime']) > int(when):
+                return _metadata
+        return {}
+
+    def pop(self, when):
+        _metadata = self.lookup(when)
+        if _metadata:
+            with self.lock:
+                _start = int(_metadata['startTime'])
+                if self._intervals.pop(_start, None) is not None:
+                    self._starts.remove(_start)
+        return _metadata
+
+    def _writetodisk(self):
+        _json = self.jsoncache
+        with open(f'{self.cache}.tmp', 'wt') as fh:
+            json.dump(_json, fh)
+        os.replace(f'{self.cache}.tmp', self.cache)
+        self.last_snapshot = time.time()
 
     def _readfromdisk(self):
         _metadata = {}
-        with self.lock:
+        try:
             with open(self.cache, 'rt') as fh:
-                try:
-                    _metadata = json.load(fh)
-                except json.JSONDecodeError:
-                    pass
+                _metadata = json.load(fh)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
         return _metadata
 
     def _getmeta(self, when):
@@ -164,13 +312,14 @@ class FIPMetadata(threading.Thread):
 
     @property
     def jsoncache(self):
-        return self._readfromdisk()
+        with self.lock:
+            return {_start: self._intervals[_start] for _start in self._starts}
 
     @jsoncache.setter
     def jsoncache(self, _json):
         with self.lock:
-            with open(self.cache, 'wt') as fh:
-                json.dump(_json, fh)
+            self._intervals = {int(_start): _json[_start] for _start in _json}
+            self._starts = sorted(self._intervals)
 
     @property
     def remains(self):
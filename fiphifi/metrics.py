@@ -0,0 +1,141 @@
+import bisect
+import logging
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from fiphifi import pipeline
+
+logger = logging.getLogger(__package__+'.metrics')
+
+#  Seconds, for request latencies against the origin and metadata API
+LATENCY = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8)
+
+#  name -> (type, help) of every metric a source may report
+FAMILIES = collections.OrderedDict((
+    ('fipshift_playlist_history_segments', ('gauge', 'Segments in the url history')),
+    ('fipshift_playlist_poll_seconds', ('histogram', 'Time to fetch the m3u8')),
+    ('fipshift_playlist_skipped_total', ('counter', 'Segments missing from the m3u8 sequence')),
+    ('fipshift_download_bytes_total', ('counter', 'Segment bytes downloaded')),
+    ('fipshift_download_segments_total', ('counter', 'Segments downloaded')),
+    ('fipshift_download_failed_total', ('counter', 'Segments given up on')),
+    ('fipshift_download_joined_total', ('counter', 'Fetches that joined one already in flight')),
+    ('fipshift_download_retries_total', ('counter', 'Segment requests retried')),
+    ('fipshift_download_notfound_total', ('counter', 'Segment requests answered 404')),
+    ('fipshift_download_refused_total', ('counter', 'Downloaded segments the store refused as already played')),
+    ('fipshift_download_seconds', ('histogram', 'Time to fetch one segment')),
+    ('fipshift_playout_offset_seconds', ('gauge', 'Age of the audio now playing')),
+    ('fipshift_playout_delta_seconds', ('gauge', 'Offset minus the configured delay')),
+    ('fipshift_playout_skipped_total', ('counter', 'Segments skipped for being too far past the delay')),
+    ('fipshift_playout_garbage_total', ('counter', 'Segments that never arrived, filled in or left out')),
+    ('fipshift_playout_restarts_total', ('counter', 'Playout sink restarts')),
+    ('fipshift_playout_drift_adjustments_total', ('counter', 'Frames dropped or repeated to hold the delay')),
+    ('fipshift_metadata_fetch_seconds', ('histogram', 'Time to fetch now playing metadata')),
+    ('fipshift_metadata_errors_total', ('counter', 'Failed metadata fetches')),
+    ('fipshift_metadata_push_seconds', ('histogram', 'Time to push a title to icecast')),
+    ('fipshift_metadata_pushes_total', ('counter', 'Titles pushed to icecast')),
+    ('fipshift_metadata_push_failed_total', ('counter', 'Title pushes icecast did not take')),
+    ('fipshift_metadata_push_coalesced_total', ('counter', 'Titles replaced by a newer one before they went out')),
+    ('fipshift_stage_depth', ('gauge', 'Items queued in a pipeline stage')),
+    ('fipshift_stage_dropped_total', ('counter', 'Items a pipeline stage dropped')),
+    ('fipshift_stage_wait_seconds', ('gauge', 'Smoothed time items wait in a pipeline stage')),
+    ('fipshift_store_bytes', ('gauge', 'Bytes held by the segment store')),
+    ('fipshift_store_segments', ('gauge', 'Segments held by the segment store')),
+    ('fipshift_listeners', ('gauge', 'Connected HTTP listeners')),
+))
+
+
+class Histogram():
+    '''Latency histogram with Prometheus' cumulative buckets.
+
+       observe() takes no lock: each histogram has one writer (or a few
+       download workers), and a count lost to a rare race costs less
+       than serialising the fetch path.'''
+
+    def __init__(self, buckets=LATENCY):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        _total = 0
+        for _le, _n in zip(list(self.buckets) + ['+Inf'], list(self.counts)):
+            _total += _n
+            yield f'{name}_bucket', dict(labels, le=str(_le)), _total
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, _total
+
+
+def stages():
+    '''Metrics of every pipeline Stage.'''
+    for _stage in list(pipeline.stages.values()):
+        _labels = {'stage': _stage.name}
+        yield 'fipshift_stage_depth', _labels, _stage.qsize()
+        yield 'fipshift_stage_dropped_total', _labels, _stage.dropped
+        yield 'fipshift_stage_wait_seconds', _labels, _stage.wait
+
+
+def render(sources):
+    '''The Prometheus text exposition of every source's metrics().'''
+    _families = collections.defaultdict(list)
+    for _source in sources:
+        try:
+            for _name, _labels, _value in _source():
+                if isinstance(_value, Histogram):
+                    _families[_name].extend(_value.samples(_name, _labels))
+                else:
+                    _families[_name].append((_name, _labels, _value))
+        except Exception as msg:
+            logger.warning("Error collecting metrics from %s: %s", _source, msg)
+    _lines = []
+    for _name, (_kind, _help) in FAMILIES.items():
+        if _name not in _families:
+            continue
+        _lines.append(f'# HELP {_name} {_help}')
+        _lines.append(f'# TYPE {_name} {_kind}')
+        for _sample, _labels, _value in _families[_name]:
+            _labelset = ','.join(f'{_k}="{_v}"' for _k, _v in _labels.items())
+            _lines.append(f'{_sample}{{{_labelset}}} {float(_value or 0):g}' if _labelset
+                          else f'{_sample} {float(_value or 0):g}')
+    return '\n'.join(_lines) + '\n'
+
+
+class MetricsServer(threading.Thread):
+    '''Serve /metrics on METRICSHOST:METRICSPORT.
+
+       Everything is read when scraped, from counters the threads keep
+       anyway, so nothing is collected between scrapes.'''
+
+    def __init__(self, _c, sources):
+        threading.Thread.__init__(self)
+        self.name = 'Metrics Thread'
+        self.daemon = True
+        self.sources = [stages] + list(sources)
+        _sources = self.sources
+
+        class _Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                _body = render(_sources).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(_body)))
+                self.end_headers()
+                self.wfile.write(_body)
+
+            def log_message(self, *args):
+                pass
+
+        self.address = (_c.get('METRICSHOST', '127.0.0.1'), _c.getint('METRICSPORT'))
+        self.server = ThreadingHTTPServer(self.address, _Handler)
+        self.server.daemon_threads = True
+
+    def run(self):
+        logger.info('Serving metrics at http://%s:%s/metrics', *self.address)
+        self.server.serve_forever()
@@ -32,6 +32,10 @@ def parseopts():
                         default=os.path.join(os.path.expanduser('~'), '.config'),
                         help="Set the dir to look for the config file.")
 
+    parser.add_argument('--asyncio', action="store_true",
+                        default=False,
+                        help="Run everything on one asyncio event loop (needs aiohttp).")
+
     parser.add_argument('--debug', action="store_true",
                         default=False,
                         help="Turn on debug logging.")
@@ -50,16 +54,21 @@ class StoreDelay(argparse.Action):
 
     def __call__(self, parser, namespace, values, option_string=None):
         setattr(namespace, self.dest, values)
+        setattr(namespace, 'delay', delayfor(values))
+
+
+def delayfor(values):
+    '''Seconds between Paris and a timezone, or a plain number of seconds.'''
+    try:
+        here = datetime.datetime(1979, 1, 1, 0, tzinfo=zoneinfo.ZoneInfo(values))
+        there = datetime.datetime(1979, 1, 1, 0, tzinfo=zoneinfo.ZoneInfo('Europe/Paris'))
+        return (here - there).seconds
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
         try:
-            here = datetime.datetime(1979, 1, 1, 0, tzinfo=zoneinfo.ZoneInfo(values))
-            there = datetime.datetime(1979, 1, 1, 0, tzinfo=zoneinfo.ZoneInfo('Europe/Paris'))
-            setattr(namespace, 'delay', (here - there).seconds)
-        except (zoneinfo.ZoneInfoNotFoundError):
-            try:
-                setattr(namespace, 'delay', int(values))
-            except ValueError:
-                raise argparse.ArgumentTypeError(f"Invalid timezone: {values}") from None
-            # setattr(namespace, 'delay', 60)  # for debugging
+            return int(values)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid timezone: {values}") from None
+        # return 60  # for debugging
 
 def doconfig(config_file):
     '''Parse config file or write a default file.'''
@@ -0,0 +1,136 @@
+import time
+import bisect
+import logging
+import threading
+import collections
+from fiphifi.demux import SAMPLESPERFRAME
+from fiphifi.constants import TSLENGTH, BUFFERSIZE
+
+logger = logging.getLogger(__package__+'.pacer')
+
+
+class Pacer():
+    '''Release AAC frames on a sample clock.
+
+       Every frame carries SAMPLESPERFRAME samples, so the time at which
+       frame n is due is epoch + n * 1024 / samplerate on the monotonic
+       clock. Output runs `lead` seconds ahead of that so the server never
+       starves, and nothing is ever skipped to keep time.'''
+
+    lead = 0.5
+    maxlate = TSLENGTH * BUFFERSIZE
+
+    def __init__(self, samplerate=44100):
+        self.samplerate = samplerate
+        self.epoch = None
+        self.samples = 0
+        self.underruns = 0
+        self.late = 0
+
+    def start(self):
+        self.epoch = time.monotonic()
+        self.samples = 0
+
+    def wait(self, frames=1):
+        _wait = self.schedule()
+        if _wait > 0:
+            time.sleep(_wait)
+        return self.advance(frames)
+
+    def schedule(self):
+        '''Seconds until the next frame is due.'''
+        if self.epoch is None:
+            self.start()
+        _late = time.monotonic() - self.due
+        if _late > self.maxlate:
+            #  We starved for longer than the buffer can cover; start a
+            #  new timeline instead of bursting everything we missed.
+            logger.warning("Pacer %0.1fs late, restarting clock.", _late)
+            self.underruns += 1
+            self.epoch += _late
+            return 0
+        return -_late
+
+    def advance(self, frames=1):
+        self.late = max(time.monotonic() - self.due, 0)
+        self.samples += frames * SAMPLESPERFRAME
+        return self.samples
+
+    @property
+    def due(self):
+        return self.epoch + self.samples / self.samplerate - self.lead
+
+    @property
+    def clock(self):
+        '''Samples that should have played out by now.'''
+        if self.epoch is None:
+            return 0
+        return int((time.monotonic() - self.epoch) * self.samplerate)
+
+    @property
+    def position(self):
+        '''Samples actually played out by now.'''
+        return min(self.clock, self.samples)
+
+    @property
+    def drift(self):
+        '''Seconds the last frame went out after it was due.'''
+        return self.late
+
+
+class Timeline():
+    '''Maps the pacer's sample position back to the wall-clock timestamp
+       of the segment the listener is hearing.
+
+       The feeder pushes one (end sample, suffix, timestamp, start) entry per
+       segment and prunes the ones that have played out, so the head is
+       always within a segment of the listener. Readers never modify it.
+       End samples only grow, so lookups bisect `_ends`.'''
+
+    def __init__(self, size=BUFFERSIZE * 2):
+        self._ring = collections.deque()
+        self._ends = collections.deque()
+        self.size = size
+        self.lock = threading.Lock()
+
+    def push(self, end, suffix, timestamp, start=0):
+        with self.lock:
+            if len(self._ring) >= self.size:
+                self._drop()
+            self._ring.append((end, suffix, timestamp, start))
+            self._ends.append(end)
+
+    def advance(self, position):
+        with self.lock:
+            #  Keep the last entry so there is always something to report
+            while len(self._ring) > 1 and self._ring[0][0] <= position:
+                self._drop()
+
+    def _drop(self):
+        self._ring.popleft()
+        self._ends.popleft()
+
+    def at(self, position):
+        '''(suffix, timestamp) playing at `position`, or (0, 0).'''
+        _entry = self._entry(position)
+        if _entry is None:
+            return 0, 0
+        return _entry[1], _entry[2]
+
+    def when(self, position, samplerate):
+        '''Wall-clock time of the audio at `position`, or 0.'''
+        _entry = self._entry(position)
+        if _entry is None or not _entry[2]:
+            return 0
+        return _entry[2] + max(position - _entry[3], 0) / samplerate
+
+    def _entry(self, position):
+        '''The first entry still playing at `position`, else the last one.'''
+        with self.lock:
+            if not self._ring:
+                return None
+            _i = bisect.bisect_right(self._ends, position)
+            return self._ring[min(_i, len(self._ring) - 1)]
+
+    def __len__(self):
+        return len(self._ring)
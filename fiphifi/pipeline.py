@@ -0,0 +1,156 @@
+import time
+import queue
+import logging
+import threading
+import collections
+
+logger = logging.getLogger(__package__+'.pipeline')
+
+#  Every Stage by name, so the threads can report on queues they do not own
+stages = collections.OrderedDict()
+
+BLOCK = 'block'
+DROP = 'drop'
+SPILL = 'spill'
+
+
+class Stage():
+    '''Bounded hand-off queue between two pipeline stages.
+
+       Speaks the queue.Queue get/put protocol. When full, put() either
+       blocks (BLOCK), drops the oldest item (DROP) or parks the item in
+       an overflow that refills the queue as it drains (SPILL). Keeps
+       depth, time spent queued and throughput for the logs.'''
+
+    alpha = 0.1
+
+    def __init__(self, name, maxsize, policy=BLOCK, ondrop=None):
+        if policy not in (BLOCK, DROP, SPILL):
+            raise ValueError(f"Unknown policy {policy}")
+        self.name = name
+        self.maxsize = max(int(maxsize), 1)
+        self.policy = policy
+        self.ondrop = ondrop
+        self._items = collections.deque()
+        self._overflow = collections.deque()
+        self._lock = threading.Lock()
+        self._notempty = threading.Condition(self._lock)
+        self._notfull = threading.Condition(self._lock)
+        self.puts = 0
+        self.gets = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.highwater = 0
+        self.blocked = 0.0
+        self.waited = 0.0
+        self._wait = 0.0
+        self._interval = 0.0
+        self._lastget = None
+        stages[name] = self
+
+    def put(self, item, block=True, timeout=None):
+        _dropped = None
+        with self._notfull:
+            if len(self._items) >= self.maxsize:
+                if self.policy == DROP:
+                    _dropped = self._items.popleft()[1]
+                    self.dropped += 1
+                elif self.policy == SPILL:
+                    self._overflow.append((time.monotonic(), item))
+                    self.spilled += 1
+                    self.puts += 1
+                    return
+                elif not block:
+                    raise queue.Full
+                else:
+                    _start = time.monotonic()
+                    _ok = self._notfull.wait_for(lambda: len(self._items) < self.maxsize, timeout)
+                    self.blocked += time.monotonic() - _start
+                    if not _ok:
+                        raise queue.Full
+            self._items.append((time.monotonic(), item))
+            self.puts += 1
+            self.highwater = max(self.highwater, len(self._items))
+            self._notempty.notify()
+        if _dropped is not None:
+            logger.debug("%s queue full, dropped oldest item.", self.name)
+            if self.ondrop is not None:
+                self.ondrop(_dropped)
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        with self._notempty:
+            if not block and not self._items:
+                raise queue.Empty
+            if not self._notempty.wait_for(lambda: self._items, timeout):
+                raise queue.Empty
+            _queued, _item = self._items.popleft()
+            if self._overflow:
+                self._items.append(self._overflow.popleft())
+            else:
+                self._notfull.notify()
+            _now = time.monotonic()
+            self.gets += 1
+            self.waited += _now - _queued
+            self._wait = self._smooth(self._wait, _now - _queued, self.gets == 1)
+            if self._lastget is not None:
+                self._interval = self._smooth(self._interval, _now - self._lastget, self.gets == 2)
+            self._lastget = _now
+        return _item
+
+    def _smooth(self, average, sample, first):
+        if first:
+            return sample
+        return average + self.alpha * (sample - average)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return len(self._items) + len(self._overflow)
+
+    def empty(self):
+        return not self.qsize()
+
+    def full(self):
+        return len(self._items) >= self.maxsize
+
+    @property
+    def depth(self):
+        return self.qsize()
+
+    @property
+    def wait(self):
+        '''Smoothed seconds an item sits in the queue.'''
+        return self._wait
+
+    @property
+    def throughput(self):
+        '''Smoothed items per second leaving the queue.'''
+        if not self._interval:
+            return 0.0
+        return 1 / self._interval
+
+    def stats(self):
+        return {'depth': self.depth,
+                'maxsize': self.maxsize,
+                'highwater': self.highwater,
+                'wait': self.wait,
+                'throughput': self.throughput,
+                'puts': self.puts,
+                'gets': self.gets,
+                'dropped': self.dropped,
+                'spilled': self.spilled,
+                'blocked': self.blocked}
+
+    def __str__(self):
+        return (f'{self.name}: {self.depth}/{self.maxsize} (max {self.highwater}) '
+                f'wait {self.wait:0.1f}s {self.throughput:0.2f}/s '
+                f'dropped {self.dropped} spilled {self.spilled} blocked {self.blocked:0.1f}s')
+
+
+def report():
+    for _stage in list(stages.values()):
+        logger.info('%s', _stage)
@@ -1,10 +1,14 @@
 import time
 import logging
 import threading
-import json
 import datetime as dt
-from fiphifi.util import parsets, checkcache
-from fiphifi.constants import FIPBASEURL, FIPLIST, STRPTIME, BUFFERSIZE, TSLENGTH
+from urllib.parse import urljoin
+from fiphifi.util import parsets, checkcache, appendcache, writecache
+from fiphifi.history import SegmentIndex
+from fiphifi.pipeline import Stage, DROP
+from fiphifi.metrics import Histogram
+from fiphifi.stations import STATIONS
+from fiphifi.constants import STRPTIME, BUFFERSIZE, TSLENGTH, COMPACTAFTER
 import requests
 
 logger = logging.getLogger(__package__+'.playlist')
@@ -15,17 +19,30 @@ class FipPlaylist(threading.Thread):
     offset = -4
     delay = 5
     duration = TSLENGTH
+    #  EXT-X-MEDIA-SEQUENCE of the last list and of the last segment ingested
+    mediasequence = -1
+    sequence = -1
 
-    def __init__(self, _alive, dlqueue, cache_file):
+    def __init__(self, _alive, dlqueue, cache_file, delay=21600, station=None, session=requests):
         threading.Thread.__init__(self)
-        self.name = 'FipPlaylist Thread'
+        self.station = station or STATIONS['fip']
+        self.name = 'FipPlaylist Thread' if self.station.slug == 'fip' else f'FipPlaylist {self.station} Thread'
         self._alive = _alive
         self.cache_file = cache_file
         self.dlqueue = dlqueue
-        self._history, self.buff = checkcache(self.cache_file)
+        self.session = session
+        #  Urls waiting out the delay; anything twice as old would be skipped anyway
+        _history, self.buff = checkcache(self.cache_file,
+                                         Stage(f'list {self.station}', 2 * delay / TSLENGTH, policy=DROP))
+        #  Every playout reads its own queue; buff is the first of them
+        self.readers = [self.buff]
+        self._history = SegmentIndex(_history)
+        self._journal = []
+        self._journaled = None
         self.lock = threading.Lock()
         self.last_update = time.time()
-        self.idx = {0:0}
+        self.polltime = Histogram()
+        self.skipped = 0
 
     def run(self):
         logger.info('Starting %s', self.name)
@@ -34,14 +51,12 @@ class FipPlaylist(threading.Thread):
         self.checkhistory()
         retries = 0
         fip_error = False
-        #  Fip reports timestamps in GMT
-        #  which is five hours in the future during EST
-        #  and four hours during EDT
-        self.offset = time.gmtime().tm_hour - dt.datetime.now().hour
-        logger.info(f'Using offset of -{self.offset} hours in playlist')
+        self.setoffset()
         while self.alive:
+            _start = time.monotonic()
             try:
-                req = requests.get(FIPLIST, timeout=self.delay)
+                req = self.session.get(self.station.listurl, timeout=2 * self.duration)
+                self.polltime.observe(time.monotonic() - _start)
                 self.parselist(req.text)
                 retries = 0
             except requests.exceptions.ConnectionError as error:
@@ -61,26 +76,53 @@ class FipPlaylist(threading.Thread):
                     else:
                         logger.warning("%s error, retrying (%s)", self.name, retries)
                         continue
-                time.sleep(self.delay)
-            if len(self._history) > self.buff.qsize():
-                self.prunehistory(self.buff.qsize() - BUFFERSIZE)
+                time.sleep(max(self.delay - (time.monotonic() - _start), 0))
+            self.trim()
         logger.info('%s wrote %s urls to cache', self.name, self.writecache())
         logger.warning('%s ended (alive: %s)', self.name, self.alive)
 
+    def setoffset(self):
+        #  Fip reports timestamps in GMT
+        #  which is five hours in the future during EST
+        #  and four hours during EDT
+        self.offset = time.gmtime().tm_hour - dt.datetime.now().hour
+        logger.info(f'Using offset of -{self.offset} hours in playlist')
+
+    def trim(self):
+        if len(self._history) > self.qsize:
+            self.prunehistory(self.qsize - BUFFERSIZE)
+
+    def subscribe(self, name, delay):
+        '''Another url queue for a playout at `delay`, starting from the
+           same history as the first.'''
+        _reader = Stage(f'list {name}', 2 * delay / TSLENGTH, policy=DROP)
+        with self.lock:
+            for _url in self._history:
+                _reader.put(_url)
+            self.readers.append(_reader)
+        return _reader
+
     def puthistory(self, _url):
         with self.lock:
-            self._history.append(_url)
+            self._history.add(_url)
+            self._journal.append(_url)
 
     def writecache(self):
         with self.lock:
-            with open(self.cache_file, 'w') as fh:
-                json.dump(self._history, fh)
+            _entries, self._journal = self._journal, []
+            if self._journaled is None or self._journaled > 2 * len(self._history) + COMPACTAFTER:
+                logger.debug("%s compacting cache to %s entries.", self.name, len(self._history))
+                writecache(self.cache_file, self._history)
+                self._journaled = len(self._history)
+            elif _entries:
+                appendcache(self.cache_file, _entries)
+                self._journaled += len(_entries)
         logger.info("%s cache: %0.0f min", self.name, len(self._history) * TSLENGTH / 60)
         return len(self._history)
 
     def gethistory(self):
         with self.lock:
-            return self._history[:]
+            return list(self._history)
 
     def prunehistory(self, until):
         if until <= 0:
@@ -88,101 +130,105 @@ class FipPlaylist(threading.Thread):
         logger.debug("%s pruning history %s -> %s.", self.name, len(self._history), until)
         logger.info("%s cache: %0.0f min", self.name, len(self._history) * TSLENGTH / 60)
         with self.lock:
-            self._history = self._history[-until:]
+            self._journal.append({'drop': len(self._history.keep(until))})
         logger.info("%s cache: %0.0f min", self.name, len(self._history) * TSLENGTH / 60)
 
     def checkhistory(self):
         logger.info('Loaded %s entries from cache.', self.qsize)
-        prefix, suffix = 0, 0
         with self.lock:
-            for _url in self._history:
-                prefix, suffix = parsets(_url[1])
-                if prefix in self.idx:
-                    self.idx[prefix].append(suffix)
-                else:
-                    self.idx = {prefix: [suffix]}
+            prefix, suffix = self._history.lastkey or (0, 0)
         if 0 not in (prefix, suffix):
             logger.info("Bootstrapping index at %s:%s", prefix, suffix)
 
     def parselist(self, _m3u):
         if not _m3u:
             logger.warning("%s: empty playlist.", self.name)
-            self.delay = 0.5
-            return
+            self.delay = self.duration / 2
+            return 0
+        _seq = None
+        _pdt = None
         _timestamp = 0
+        _new = 0
         for _l in _m3u.split('\n'):
             if not _l:
                 continue
-            if '#EXT-X-PROGRAM-DATE-TIME' in _l:
-                _dt = ':'.join(_l.strip().split(':')[1:])
+            if _l[0] != '#':
+                if _seq is not None:
+                    _seq += 1
+                    if _seq <= self.sequence:
+                        continue
+                #  Only segments we have not seen yet pay for strptime
+                if _pdt is not None:
+                    _timestamp = self.parsepdt(_pdt)
+                    _pdt = None
+                self.ingest_url([_timestamp, urljoin(self.station.listurl, _l.strip())])
+                _new += 1
+            elif _l.startswith('#EXT-X-PROGRAM-DATE-TIME'):
+                _pdt = _l
+            elif _l.startswith('#EXT-X-MEDIA-SEQUENCE'):
                 try:
-                    _dt = dt.datetime.strptime(_dt, STRPTIME) - dt.timedelta(hours=self.offset)
-                    _timestamp = _dt.timestamp()
-                except ValueError:
-                    _timestamp = 0
-            if '#EXT-X-TARGETDURATION' in _l:
+                    _seq = int(_l.strip().split(':')[-1]) - 1
+                except (IndexError, ValueError):
+                    logger.warning("Error finding media sequence from %s", _l.strip())
+                    continue
+                if _seq < self.mediasequence - 1:
+                    #  The sequence never goes backwards unless the origin restarted
+                    logger.info("%s media sequence went back to %s, rescanning.", self.name, _seq + 1)
+                    self.sequence = -1
+                self.mediasequence = _seq + 1
+            elif _l.startswith('#EXT-X-TARGETDURATION'):
                 try:
                     self.duration = int(_l.strip().split(':')[-1])
                 except (IndexError, ValueError):
                     logger.warning("Error finding duration from %s", _l.strip())
-            if _l[0] == '#':
-                continue
-            self.ingest_url([_timestamp, f'{FIPBASEURL}{_l.strip()}'])
-        if not _timestamp:
+        if _seq is not None:
+            self.sequence = max(self.sequence, _seq)
+        if _new and not _timestamp:
             logger.warning("%s did not parse the playlist", self.name)
         self.last_update = time.time()
-        self.delay = 20
+        #  RFC 8216 6.3.4: reload after one target duration when the list
+        #  grew, half of one when it did not.
+        self.delay = self.duration if _new else self.duration / 2
+        return _new
+
+    def parsepdt(self, _l):
+        _dt = ':'.join(_l.strip().split(':')[1:])
+        try:
+            _dt = dt.datetime.strptime(_dt, STRPTIME) - dt.timedelta(hours=self.offset)
+        except ValueError:
+            return 0
+        return _dt.timestamp()
 
     def ingest_url(self, _url):
         prefix, suffix = parsets(_url[1])
-        if 0 in (prefix, suffix):
+        if 0 in (prefix, suffix) or not self.station.owns(_url[1]):
             logger.warning('Malformed url: %s', _url[1])
             return
-        if _url in self._history:
+        if (prefix, suffix) in self._history:
             logger.debug("%s m3u overlap %s:%s ", self.name, prefix, suffix)
             return
-        if prefix in self.idx:
-            _last_suffix = self.idx[prefix][-1]
-            if suffix > _last_suffix:
-                self.idx[prefix].append(suffix)
-                if suffix - _last_suffix > 1:
-                    logger.warning("%s skipped a file %s: %s -> %s", self.name, prefix, _last_suffix, suffix)
-            elif suffix < _last_suffix:
+        _last_prefix, _last_suffix = self._history.lastkey or (0, 0)
+        if prefix == _last_prefix:
+            if suffix < _last_suffix:
                 logger.debug("%s backwads url order %s: %s -> %s", self.name, prefix, _last_suffix, suffix)
                 return
-            elif suffix == _last_suffix:
-                logger.debug("%s same url twice in a row %s: %s ", self.name, prefix, suffix)
-                return
-            else:
-                logger.debug("%s file out of order for %s: %s -> %s", self.name, prefix, _last_suffix, suffix)
-            # elif suffix - _last_suffix > 1:
-            #     logger.info("%s guessing at missing ts. Last: %s Now: %s", self.name, _last_suffix, suffix)
-            #     _suffix = suffix - (suffix - _last_suffix) + 1
-            #     _prefix = prefix
-            #     _i = 1
-            #     while suffix > _suffix:
-            #         if len(self.idx[_prefix]) >= 25:
-            #             _prefix += 1
-            #         self.idx[_prefix].append(_suffix)
-            #         _new_timestamp = _url[0] - (TSLENGTH * _i)
-            #         _new_url = _url[1].replace(str(prefix),
-            #                                    str(_prefix)).replace(str(suffix),
-            #                                                          str(_suffix))
-            #         logger.info("%s guessed: %s @ %s", self.name, _new_timestamp, _new_url)
-            #         self._cache_url([_new_timestamp, _new_url])
-            #         _suffix += 1
-            #         _i += 1
-            # else:
-            #     logger.debug("%s resetting prefix: %s", self.name, prefix)
-            #     self.idx = {prefix: [suffix]}
+            if suffix - _last_suffix > 1:
+                logger.warning("%s skipped a file %s: %s -> %s", self.name, prefix, _last_suffix, suffix)
+                self.skipped += suffix - _last_suffix - 1
         else:
             logger.debug("%s incrementing prefix: %s", self.name, prefix)
-            self.idx = {prefix: [suffix]}
         self.puthistory(_url)
-        self.buff.put(_url)
-        self.dlqueue.put(_url[1])
+        for _reader in self.readers:
+            _reader.put(_url)
+        self.dlqueue.put_nowait(_url[1])
         logger.debug("%s cached %s @ %s:%s", self.name, _url[0], prefix, suffix)
 
+    def metrics(self):
+        _labels = {'station': self.station.slug}
+        yield 'fipshift_playlist_history_segments', _labels, len(self._history)
+        yield 'fipshift_playlist_poll_seconds', _labels, self.polltime
+        yield 'fipshift_playlist_skipped_total', _labels, self.skipped
+
     @property
     def alive(self):
         return self._alive.isSet()
@@ -201,13 +247,12 @@ class FipPlaylist(threading.Thread):
 
     @urlq.setter
     def urlq(self, _queue):
+        self.readers[self.readers.index(self.buff)] = _queue
         self.buff = _queue
 
     @property
     def qsize(self):
-        if self.buff.empty():
-            return 0
-        return self.buff.qsize()
+        return max(_reader.qsize() for _reader in self.readers)
 
     @property
     def tslength(self):
@@ -1,9 +1,8 @@
-import os
 import time
 import logging
 import threading
-import queue
 from fiphifi.buffer import Buffer
+from fiphifi.pipeline import report
 from fiphifi.constants import TSLENGTH
 
 
@@ -17,11 +16,13 @@ class AACStream(threading.Thread):
     buffer = None
     duration = TSLENGTH
 
-    def __init__(self, _alive, urlqueue, delay, config, **kwargs):
+    def __init__(self, _alive, urlqueue, delay, config, store, **kwargs):
         threading.Thread.__init__(self)
         self.name = 'AAC Sender Thread'
         self._alive = _alive
         self.urlq = urlqueue
+        self.store = store
+        self.fetcher = kwargs.get('fetcher')
         self._delay = delay
         self.config = config
         self._timestamp = 0
@@ -34,30 +35,29 @@ class AACStream(threading.Thread):
         buffer_alive.set()
         self.buffer = Buffer(buffer_alive,
                              self.urlq,
-                             config=self.config)
+                             config=self.config,
+                             store=self.store,
+                             delay=self.delay,
+                             fetcher=self.fetcher)
         self.buffer.start()
-        offset_tolerace = int(0.1 * self.delay) or 16
-        logger.debug('Setting offset tolerance to %ss', offset_tolerace)
+        _report = time.time()
         while self.alive:
             if not self.buffer.is_alive() and self.alive:
                 logger.warning('Buffer died, trying to restart.')
                 self.buffer = Buffer(buffer_alive,
                                      self.urlq,
-                                     config=self.config)
+                                     config=self.config,
+                                     store=self.store,
+                                     delay=self.delay,
+                                     fetcher=self.fetcher)
                 self.buffer.start()
-            if offset_tolerace < self.delta < 100000:  # Offset throws huge numbers when timestamp returns 0
-                logger.info('Offset: %0.0f / Delay: %0.0f / Tolerance: %0.0f / Diff: %0.0f',
-                            self.offset, self.delay, offset_tolerace, self.delta - offset_tolerace)
-                skipped = 1
-                try:
-                    _timestamp, _ = self.urlq.get(timeout=5)
-                    while time.time() - _timestamp > self.delay:
-                        _timestamp, _ = self.urlq.get(timeout=5)
-                        skipped += 1
-                except queue.Empty:
-                    pass
-                logger.info("Sskipped %s urls to keep delay.", skipped)
-                logger.debug('Offset: %0.0f / Delay: %0.0f', self.offset, self.delay)
+            #  The delay itself is held by the Buffer's drift controller
+            if time.time() - _report > 60:
+                logger.info('Offset: %0.0f / Delay: %0.0f / Delta: %0.1f / Drift: %0.3f',
+                            self.offset, self.delay, self.delta, self.drift)
+                logger.info('Drift correction: %s', self.buffer.controller)
+                report()
+                _report = time.time()
             time.sleep(self.duration)
         logger.warning('%s dying (alive: %s)', self.name, self.alive)
         buffer_alive.clear()
@@ -71,6 +71,19 @@ class AACStream(threading.Thread):
                 logger.warning("%s refusing to die.", self.buffer.name)
         logger.warning('%s ending.', self.name)
 
+    def metrics(self):
+        _labels = {'mount': self.config['USEROPTS']['MOUNT']}
+        if self.buffer is None:
+            return
+        yield 'fipshift_playout_offset_seconds', _labels, self.offset
+        yield 'fipshift_playout_delta_seconds', _labels, self.delta
+        yield 'fipshift_playout_skipped_total', _labels, self.buffer.skipped
+        yield 'fipshift_playout_garbage_total', _labels, self.buffer.garbage
+        yield 'fipshift_playout_restarts_total', _labels, self.buffer.playlist.restarts
+        yield 'fipshift_playout_drift_adjustments_total', _labels, self.buffer.controller.adjustments
+        if hasattr(self.buffer.playlist.sink, 'listeners'):
+            yield 'fipshift_listeners', _labels, self.buffer.playlist.sink.listeners
+
     @property
     def alive(self):
         return self._alive.isSet()
@@ -82,6 +95,12 @@ class AACStream(threading.Thread):
         else:
             return 0
 
+    @property
+    def drift(self):
+        if self.buffer is not None:
+            return self.buffer.drift
+        return 0
+
     @property
     def offset(self):
         return time.time() - self.timestamp
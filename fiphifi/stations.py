@@ -0,0 +1,78 @@
+import re
+import configparser
+from fiphifi.constants import FIPBASEURL, FIPLIST, METAURL, LIVEURL
+
+
+class Station():
+    '''Where one Radio France webradio keeps its playlist, segments,
+       metadata and live stream.'''
+
+    def __init__(self, slug, webradio, listurl=None, metaurl=None, liveurl=None):
+        self.slug = slug
+        self.webradio = webradio
+        self.listurl = listurl or f'{FIPBASEURL}/{slug}/{slug}_hifi.m3u8?id=radiofrance'
+        self.metaurl = metaurl or f'https://www.radiofrance.fr/fip/api/live/webradios/{webradio}'
+        self.liveurl = liveurl or f'https://icecast.radiofrance.fr/{slug}-hifi.aac?id=radiofrance'
+        self.tsre = re.compile(fr'(.*?{slug}_aac_hifi_\d_)(\d+)_(\d+)\.ts.*')
+
+    def owns(self, url):
+        return self.tsre.match(url) is not None
+
+    def __str__(self):
+        return self.slug
+
+
+STATIONS = {_station.slug: _station for _station in (
+    Station('fip', 'fip', listurl=FIPLIST, metaurl=METAURL, liveurl=LIVEURL),
+    Station('fipjazz', 'fip_jazz'),
+    Station('fipgroove', 'fip_groove'),
+    Station('fiprock', 'fip_rock'),
+    Station('fipreggae', 'fip_reggae'),
+    Station('fipelectro', 'fip_electro'),
+    Station('fipworld', 'fip_world'),
+    Station('fipnouveautes', 'fip_nouveautes'),
+    Station('fippop', 'fip_pop'),
+    Station('fipmetal', 'fip_metal'),
+    Station('fiphiphop', 'fip_hiphop'),
+    Station('fipsacrefrancais', 'fip_sacre_francais'),
+)}
+
+
+def stationof(name):
+    '''Slug of the station a segment name or url belongs to.'''
+    _name = name.split('?')[0].rsplit('/', 1)[-1]
+    return _name.split('_aac_')[0]
+
+
+def configured(config):
+    '''[(Station, config)] for every slug in STATIONS, with a [slug]
+       section of the config file laid over USEROPTS. Stations other
+       than fip default to the mount <slug>.aac. LISTURL, METAURL and
+       LIVEURL in a [slug] section point that station at another origin.'''
+    _c = config['USEROPTS']
+    _stations = []
+    for _slug in _c.get('STATIONS', 'fip').split(','):
+        _slug = _slug.strip()
+        if not _slug:
+            continue
+        if _slug not in STATIONS:
+            raise ValueError(f"Unknown station {_slug}, expected one of {', '.join(STATIONS)}")
+        _opts = dict(config.items('USEROPTS', raw=True))
+        if _slug != 'fip':
+            _opts['mount'] = f'{_slug}.aac'
+            _opts['outputs'] = ''
+        _station = STATIONS[_slug]
+        if config.has_section(_slug):
+            _opts.update(config.items(_slug, raw=True))
+            #  Another origin for this station, e.g. a local one for testing
+            _urls = {_key: config.get(_slug, _key, raw=True) for _key in ('listurl', 'metaurl', 'liveurl')
+                     if config.has_option(_slug, _key)}
+            if _urls:
+                _station = Station(_slug, _station.webradio,
+                                   listurl=_urls.get('listurl', _station.listurl),
+                                   metaurl=_urls.get('metaurl', _station.metaurl),
+                                   liveurl=_urls.get('liveurl', _station.liveurl))
+        _config = configparser.ConfigParser()
+        _config.read_dict({'USEROPTS': _opts})
+        _stations.append((_station, _config))
+    return _stations
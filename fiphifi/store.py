@@ -0,0 +1,311 @@
+import os
+import mmap
+import logging
+import threading
+import collections
+from fiphifi.util import get_tmpdir
+from fiphifi.manifest import ManifestStore, MANIFEST
+from fiphifi.constants import TSLENGTH, BUFFERSIZE, BITRATE, MAXMEMORY
+
+logger = logging.getLogger(__package__+'.store')
+
+
+def segmentname(url):
+    return os.path.basename(url.split('?')[0])
+
+
+def segmentstore(config, delay, stations=1):
+    _c = config['USEROPTS']
+    _dldir = os.path.join(get_tmpdir(_c), 'ts')
+    if not os.path.exists(_dldir):
+        os.makedirs(_dldir)
+    _kind = _c.get('STORE', 'ring')
+    #  Only what is on disk outlives a restart, so only that is journaled
+    _manifest = os.path.join(_dldir, MANIFEST)
+    if _kind == 'ring':
+        return ManifestStore(RingStore(os.path.join(_dldir, 'ring.dat'), ringsize(delay) * stations), _manifest)
+    if _kind == 'memory':
+        if os.path.exists(_manifest):
+            os.remove(_manifest)
+        _budget = _c.getint('MAXMEMORY', fallback=MAXMEMORY) * 1024 * 1024
+        if _budget < ringsize(delay) * stations:
+            logger.warning("MAXMEMORY is less than the delay needs, older segments will spill to disk.")
+        return MemoryStore(_budget, FileStore(_dldir))
+    if _kind != 'files':
+        logger.warning("Unknown STORE %s, using files.", _kind)
+    return ManifestStore(FileStore(_dldir), _manifest)
+
+
+def ringsize(delay):
+    #  Room for the whole delay plus a few buffers of slack, with
+    #  headroom for TS overhead on top of the nominal bitrate.
+    return int((delay + 4 * TSLENGTH * BUFFERSIZE) * BITRATE / 8 * 1.25)
+
+
+class FileStore():
+    '''One file per segment in dldir.'''
+
+    def __init__(self, dldir):
+        self.dldir = dldir
+
+    def path(self, name):
+        return os.path.join(self.dldir, name)
+
+    def put(self, name, data):
+        _tmp = self.path(f'.{name}.part')
+        with open(_tmp, 'wb') as fh:
+            fh.write(data)
+        os.replace(_tmp, self.path(name))
+        return True
+
+    def get(self, name):
+        try:
+            with open(self.path(name), 'rb') as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+    def open(self, name):
+        '''(fd, offset, length) of a segment for sendfile(); close fd when done.'''
+        try:
+            _fd = os.open(self.path(name), os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        return _fd, 0, os.fstat(_fd).st_size
+
+    def discard(self, name):
+        try:
+            os.unlink(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def names(self):
+        '''Every segment (or partial download) in dldir.'''
+        return [_f for _f in os.listdir(self.dldir) if _f.endswith(('.ts', '.part'))]
+
+    def close(self):
+        pass
+
+    def __contains__(self, name):
+        return os.path.exists(self.path(name))
+
+
+class RingStore():
+    '''Segments packed back to back in one preallocated, memory-mapped file.
+
+       New segments overwrite the oldest ones once the ring wraps, so disk
+       use is fixed at `size`. get() hands out memoryviews of the map, which
+       stay valid until the ring comes round again (a whole delay later).'''
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._fh = open(path, 'a+b')
+        if os.fstat(self._fh.fileno()).st_size != size:
+            self._fh.truncate(size)
+            try:
+                os.posix_fallocate(self._fh.fileno(), 0, size)
+            except (AttributeError, OSError):
+                pass
+        self._mmap = mmap.mmap(self._fh.fileno(), size)
+        self._view = memoryview(self._mmap)
+        self._index = collections.OrderedDict()
+        self._head = 0
+        self.lock = threading.Lock()
+        logger.info("Ring store %s (%0.0f MB)", path, size / 1024 / 1024)
+
+    def put(self, name, data):
+        _n = len(data)
+        if _n > self.size:
+            logger.error("Segment %s larger than the ring.", name)
+            return False
+        with self.lock:
+            self._index.pop(name, None)
+            if self._head + _n > self.size:
+                self._evict(self._head, self.size)
+                self._head = 0
+            self._evict(self._head, self._head + _n)
+            self._view[self._head:self._head + _n] = data
+            self._index[name] = (self._head, _n)
+            self._head += _n
+        return True
+
+    def _evict(self, start, end):
+        #  Live entries sit in ring order after head, oldest first
+        while self._index:
+            _name, (_offset, _n) = next(iter(self._index.items()))
+            if _offset >= end or _offset + _n <= start:
+                break
+            self._index.popitem(last=False)
+
+    def get(self, name):
+        with self.lock:
+            _loc = self._index.get(name)
+        if _loc is None:
+            return None
+        return self._view[_loc[0]:_loc[0] + _loc[1]]
+
+    def locate(self, name):
+        with self.lock:
+            return self._index.get(name)
+
+    def open(self, name):
+        _loc = self.locate(name)
+        if _loc is None:
+            return None
+        return os.dup(self._fh.fileno()), _loc[0], _loc[1]
+
+    def adopt(self, name, offset, n):
+        '''Index a segment already in the ring, as put() would have.'''
+        if offset < 0 or offset + n > self.size:
+            return
+        with self.lock:
+            self._index.pop(name, None)
+            if offset < self._head:
+                self._evict(self._head, self.size)
+            self._evict(offset, offset + n)
+            self._index[name] = (offset, n)
+            self._head = offset + n
+
+    def discard(self, name):
+        with self.lock:
+            self._index.pop(name, None)
+
+    def close(self):
+        self._mmap.flush()
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            logger.debug("Ring store still has readers, leaving it mapped.")
+        self._fh.close()
+
+    def __contains__(self, name):
+        return name in self._index
+
+
+class MemoryStore():
+    '''Segments kept in RAM as one bytes block each, up to `maxmemory`.
+
+       Past the budget the oldest blocks are spilled to `spill` (a
+       FileStore), so short delays never touch the disk. Spills are
+       written outside the lock; until they land, the blocks are still
+       served from `_pending`.'''
+
+    def __init__(self, maxmemory, spill):
+        self.maxmemory = maxmemory
+        self.spill = spill
+        self._blocks = collections.OrderedDict()
+        self._spilled = set()
+        self._pending = {}
+        self._used = 0
+        self.lock = threading.Lock()
+        logger.info("Memory store (%0.0f MB)", maxmemory / 1024 / 1024)
+
+    def put(self, name, data):
+        _block = bytes(data)
+        _spills = []
+        with self.lock:
+            self._drop(name)
+            self._blocks[name] = _block
+            self._used += len(_block)
+            while self._used > self.maxmemory and len(self._blocks) > 1:
+                _name, _old = self._blocks.popitem(last=False)
+                self._used -= len(_old)
+                self._pending[_name] = _old
+                _spills.append((_name, _old))
+        for _name, _old in _spills:
+            self.spill.put(_name, _old)
+            with self.lock:
+                if self._pending.get(_name) is _old:
+                    del self._pending[_name]
+                    self._spilled.add(_name)
+                    continue
+                _stale = _name not in self._pending and _name not in self._blocks
+            if _stale:
+                #  Discarded while it was being written
+                self.spill.discard(_name)
+        return True
+
+    def _drop(self, name):
+        _block = self._blocks.pop(name, None)
+        if _block is not None:
+            self._used -= len(_block)
+        self._pending.pop(name, None)
+        if name in self._spilled:
+            self._spilled.discard(name)
+            self.spill.discard(name)
+
+    def get(self, name):
+        with self.lock:
+            _block = self._blocks.get(name) or self._pending.get(name)
+            _spilled = _block is None and name in self._spilled
+        if _spilled:
+            return self.spill.get(name)
+        return _block
+
+    def discard(self, name):
+        with self.lock:
+            self._drop(name)
+
+    def close(self):
+        with self.lock:
+            for _name in self._spilled:
+                self.spill.discard(_name)
+            self._spilled.clear()
+            self._pending.clear()
+            self._blocks.clear()
+            self._used = 0
+
+    def __contains__(self, name):
+        return name in self._blocks or name in self._pending or name in self._spilled
+
+    @property
+    def used(self):
+        return self._used
+
+    def metrics(self):
+        yield 'fipshift_store_bytes', {}, self._used
+        yield 'fipshift_store_segments', {}, len(self._blocks) + len(self._pending) + len(self._spilled)
+
+
+class SharedStore():
+    '''One store read by several playouts at different delays.
+
+       A segment is only discarded from the wrapped store once every
+       reader has discarded it, so the longest delay sets the lifetime.'''
+
+    def __init__(self, store, readers):
+        self.store = store
+        self.readers = readers
+        self._released = {}
+        self.lock = threading.Lock()
+
+    def put(self, name, data):
+        return self.store.put(name, data)
+
+    def get(self, name):
+        return self.store.get(name)
+
+    def discard(self, name):
+        with self.lock:
+            _n = self._released.get(name, 0) + 1
+            if _n < self.readers:
+                self._released[name] = _n
+                return
+            self._released.pop(name, None)
+        self.store.discard(name)
+
+    def forget(self, name):
+        '''Drop the count for a segment discarded behind the readers' backs.'''
+        with self.lock:
+            self._released.pop(name, None)
+
+    def close(self):
+        self.store.close()
+
+    def __contains__(self, name):
+        return name in self.store
+
+    def __getattr__(self, attr):
+        return getattr(self.store, attr)
@@ -2,9 +2,11 @@ import os
 import time
 import json
 import queue
+import collections
 import re
 
-TSRE = re.compile(r'(.*?/fip_aac_hifi_\d_)(\d+)_(\d+)\.ts.*')
+#  Segment names of every station look like <slug>_aac_hifi_<n>_<prefix>_<suffix>.ts
+TSRE = re.compile(r'(.*?_aac_hifi_\d_)(\d+)_(\d+)\.ts.*')
 
 def parsets(ts):
     _m = re.match(TSRE, ts)
@@ -18,13 +20,21 @@ def get_tmpdir(_c):
     return os.path.join(_c['TMPDIR'], 'fipshift')
 
 def cleantmpdir(tmpdir):
+    #  With a segment manifest the store and url caches are kept for a
+    #  warm restart; the manifest and its Collector decide what is still
+    #  good, so only the logs at the top need rotating.
+    warm = os.path.exists(os.path.join(tmpdir, 'ts', 'manifest.jsonl'))
     n = 0
-    for root, __, files in os.walk(tmpdir):
+    for root, dirs, files in os.walk(tmpdir):
+        if warm:
+            dirs.clear()
         for _f in files:
             _old = os.path.join(root, _f)
             if _f[-4:].lower() == ('.log'):
                 os.replace(_old, f'{_old}.1')
                 n += 1
+            if warm:
+                continue
             if _f[-6:].lower() == '.cache':
                 if time.time() - os.stat(_old).st_mtime > 600:
                     os.remove(_old)
@@ -36,20 +46,42 @@ def cleantmpdir(tmpdir):
     return n
 
 
-def checkcache(cache):
-    _urlqueue = queue.SimpleQueue()
-    _urlz = []
+def checkcache(cache, urlqueue=None):
+    '''Replay the url journal: one [timestamp, url] per line, with
+       {"drop": n} lines recording evictions from the front. A torn
+       last line from a crash is skipped.'''
+    _urlqueue = queue.SimpleQueue() if urlqueue is None else urlqueue
+    _urlz = collections.deque()
     if os.path.exists(cache):
         with open(cache) as fh:
-            try:
-                _urlz = json.load(fh)
-                for _url in _urlz:
-                    _urlqueue.put_nowait(_url)
-            except json.JSONDecodeError:
-                os.remove(cache)
-    return _urlz, _urlqueue
+            for _line in fh:
+                try:
+                    _entry = json.loads(_line)
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(_entry, dict):
+                    for __ in range(min(_entry.get('drop', 0), len(_urlz))):
+                        _urlz.popleft()
+                elif _entry and isinstance(_entry[0], list):
+                    #  Cache written as one JSON list by older versions
+                    _urlz.extend(_entry)
+                elif len(_entry) == 2:
+                    _urlz.append(_entry)
+    for _url in _urlz:
+        _urlqueue.put_nowait(_url)
+    return list(_urlz), _urlqueue
 
-def writecache(cache, _urlz):
-    with open(cache, 'w') as fh:
-        json.dump(_urlz, fh)
+def appendcache(cache, _entries):
+    with open(cache, 'a') as fh:
+        for _entry in _entries:
+            fh.write(json.dumps(_entry) + '\n')
+        fh.flush()
+        os.fsync(fh.fileno())
 
+def writecache(cache, _urlz):
+    with open(f'{cache}.tmp', 'w') as fh:
+        for _url in _urlz:
+            fh.write(json.dumps(_url) + '\n')
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(f'{cache}.tmp', cache)
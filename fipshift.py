@@ -8,23 +8,40 @@ import logging
 import time
 import subprocess
 import signal
-import queue
 from argparse import ArgumentTypeError
-from fiphifi.util import get_tmpdir, cleantmpdir
+from fiphifi.util import get_tmpdir, cleantmpdir, checkcache
 from fiphifi.logging import FipFormatter
 from fiphifi.playlist import FipPlaylist
 from fiphifi.sender import AACStream
+from fiphifi.hls import HLSStream
+from fiphifi.buffer import Buffer
 from fiphifi.downloader import Downloader
+from fiphifi.store import segmentstore, segmentname, SharedStore
+from fiphifi.manifest import ManifestStore, Collector
+from fiphifi.fanout import outputs
+from fiphifi.stations import configured
+from fiphifi.pipeline import Stage, SPILL, report
 from fiphifi.options import parseopts
-from fiphifi.metadata import FIPMetadata, send_metadata
-from fiphifi.constants import TSLENGTH
+from fiphifi.metadata import FIPMetadata, MetadataPusher
+from fiphifi.icecast import IcecastRelay
+from fiphifi.listen import HTTPSink, closelisteners
+from fiphifi.metrics import MetricsServer
+from fiphifi.constants import TSLENGTH, LIVEURL, BUFFERSIZE, DLWORKERS
 
-def vampstream(FFMPEG, _c):
+def vampstream(FFMPEG, _c, url=LIVEURL):
+    if _c.get('PLAYOUT') == 'hls':
+        #  Nothing to relay: the playlist is simply not there until the delay is up
+        return None
+    if _c.get('PLAYOUT', 'native') in ('native', 'http'):
+        _sink = HTTPSink(_c) if _c.get('PLAYOUT') == 'http' else None
+        _relay = IcecastRelay(_c, url, sink=_sink)
+        _relay.start()
+        return _relay
     _ffmpegcmd = [FFMPEG,
                   '-loglevel', 'fatal',
                   '-nostdin',
                   '-re',
-                  '-i', 'https://icecast.radiofrance.fr/fip-hifi.aac?id=radiofrance',
+                  '-i', url,
                   '-content_type', 'audio/aac',
                   '-ice_name', 'FipShift',
                   '-ice_description', 'Time-shifted FIP stream',
@@ -48,6 +65,11 @@ def cleanup(*args):
                 logger.warning("%s refusing to die.", children[child].name)
         except RuntimeError:
             pass
+    for _output in OUTPUTS:
+        if _output.vamp is not None:
+            _output.vamp.terminate()
+    closelisteners()
+    STORE.close()
     logger.debug("Cleaned %s files in %s.", cleantmpdir(TMPDIR), TMPDIR)
     CLEAN = True
     sys.exit()
@@ -109,114 +131,235 @@ else:
 
 logger.info("Starting buffer threads.")
 
+try:
+    STATIONS = configured(config)
+    OUTPUTS = []
+    for _station, _config in STATIONS:
+        for _output in outputs(opts, _config):
+            _output.station = _station
+            OUTPUTS.append(_output)
+    if len({_output.mount for _output in OUTPUTS}) < len(OUTPUTS):
+        raise ValueError("two stations play to the same mount")
+except (ArgumentTypeError, ValueError) as msg:
+    logger.error("Bad STATIONS or OUTPUTS in config: %s", msg)
+    sys.exit(1)
+#  One download buffer deep enough for the longest delay feeds every output
+DELAY = max(_output.delay for _output in OUTPUTS)
+
 CLEAN = False
 CACHE = os.path.join(TMPDIR, 'fipshift.cache')
 DLDIR = os.path.join(TMPDIR, 'ts')
-DLQUEUE = queue.SimpleQueue()
+#  Urls are only live on the CDN for a while, so a backed up download queue spills instead of dropping
+DLQUEUE = Stage('download', BUFFERSIZE * (_c.getint('DLWORKERS', fallback=DLWORKERS) or 1), policy=SPILL)
+STORE = segmentstore(config, DELAY, len(STATIONS))
 ALIVE = threading.Event()
 children = {}
+#  Stores read by several outputs, whose release counts the Collector clears
+SHARED = []
+
+
+def stationcache(_station):
+    if _station.slug == 'fip':
+        return CACHE
+    return os.path.join(TMPDIR, f'{_station}.cache')
+
+
+#  A url cache older than the longest delay holds nothing that will still be played
+for _station, _ in STATIONS:
+    if os.path.exists(stationcache(_station)) and time.time() - os.path.getmtime(stationcache(_station)) > DELAY:
+        os.remove(stationcache(_station))
+#  Segments that survived the last run, checked against the manifest
+RESTORED = STORE.restore() if isinstance(STORE, ManifestStore) else set()
+
+
+if opts.asyncio:
+    from fiphifi.aio import run
+    if len(OUTPUTS) > 1:
+        logger.warning("The asyncio runtime plays one output, using %s.", OUTPUTS[0])
+    if OUTPUTS[0].config['USEROPTS'].get('PLAYOUT', 'native') != 'native':
+        logger.warning("The asyncio runtime only pushes to icecast itself, using PLAYOUT=native.")
+    opts.delay = OUTPUTS[0].delay
+    #  The runtime fetches what its cached history lacks; anything else restored is never played
+    _history, _ = checkcache(stationcache(OUTPUTS[0].station))
+    for _ts in RESTORED - {segmentname(_url) for _, _url in _history}:
+        STORE.discard(_ts)
+    _collector = None
+    if isinstance(STORE, ManifestStore):
+        ALIVE.set()
+        _collector = Collector(ALIVE, STORE, DELAY + Buffer.skipafter + TSLENGTH * BUFFERSIZE)
+        _collector.start()
+    try:
+        run(opts, OUTPUTS[0].config, STORE, stationcache(OUTPUTS[0].station), OUTPUTS[0].station)
+    finally:
+        ALIVE.clear()
+        if _collector is not None:
+            _collector.join(timeout=2 * TSLENGTH)
+        STORE.close()
+        logger.debug("Cleaned %s files in %s.", cleantmpdir(TMPDIR), TMPDIR)
+    sys.exit()
+
+#  Every station shares the download pool and its connections, and every
+#  playout fetches the segments the pool has not got to through it
+children["downloader"] = Downloader(ALIVE, DLQUEUE, config, STORE, pollers=2 * len(STATIONS) + len(OUTPUTS))
+for _station, _ in STATIONS:
+    _outputs = [_output for _output in OUTPUTS if _output.station is _station]
+    _delay = max(_output.delay for _output in _outputs)
+    _name = '' if _station.slug == 'fip' else f' {_station}'
+    _store = STORE if len(_outputs) == 1 else SharedStore(STORE, len(_outputs))
+    if isinstance(_store, SharedStore):
+        SHARED.append(_store)
+    _playlist = children[f"playlist{_name}"] = FipPlaylist(ALIVE, DLQUEUE, stationcache(_station), delay=_delay,
+                                                           station=_station,
+                                                           session=children["downloader"].session)
+    #  Fetch what the cached history still needs and the store lost
+    _missing = 0
+    for _timestamp, _url in _playlist.history:
+        if segmentname(_url) in RESTORED:
+            RESTORED.discard(segmentname(_url))
+        elif time.time() - _timestamp - _delay < Buffer.skipafter:
+            DLQUEUE.put(_url)
+            _missing += 1
+    if _missing:
+        logger.info("%s: %s cached segments missing from the store, fetching.", _station, _missing)
+    _metadata = children[f"metadata{_name}"] = FIPMetadata(ALIVE, tmpdir=TMPDIR, delay=_delay,
+                                                           station=_station,
+                                                           session=children["downloader"].session)
+    for _i, _output in enumerate(_outputs):
+        if _i == 0:
+            _urlq = _playlist.urlq
+        else:
+            _urlq = _playlist.subscribe(_output.mount, _output.delay)
+        _output.playlist = _playlist
+        _output.metadata = _metadata
+        _playout = _output.config['USEROPTS'].get('PLAYOUT', 'native')
+        if _playout not in ('http', 'hls'):
+            #  Titles only have somewhere to go with an icecast server
+            _output.pusher = children[f"pusher {_output.mount}"] = MetadataPusher(ALIVE, _output.config['USEROPTS'])
+        _sender = HLSStream if _playout == 'hls' else AACStream
+        _output.sender = children[f"sender {_output.mount}"] = _sender(ALIVE, _urlq, _output.delay,
+                                                                       _output.config, _store,
+                                                                       fetcher=children["downloader"])
+        #  A url that falls off a full queue will never be played, so release its segment
+        _urlq.ondrop = lambda _url, _store=_store: _store.discard(segmentname(_url[1]))
 
-children["playlist"] = FipPlaylist(ALIVE, DLQUEUE, CACHE)
-children["downloader"] = Downloader(ALIVE, DLQUEUE, config)
-children["metadata"] = FIPMetadata(ALIVE, tmpdir=TMPDIR)
-children["sender"] = AACStream(ALIVE, children["playlist"].urlq, opts.delay, config)
+#  Whatever is left belongs to no cached history and would never be played
+for _ts in RESTORED:
+    STORE.discard(_ts)
+if isinstance(STORE, ManifestStore):
+    #  Nothing is played once it is further behind the longest delay than a playout would skip
+    children["collector"] = Collector(ALIVE, STORE, DELAY + Buffer.skipafter + TSLENGTH * BUFFERSIZE,
+                                      shared=SHARED)
+
+if _c.get('METRICSPORT'):
+    #  Not a child: it serves until the process exits and is never joined
+    METRICS = MetricsServer(_c, [children[_child].metrics for _child in children
+                                 if hasattr(children[_child], 'metrics')]
+                            + ([STORE.metrics] if hasattr(STORE, 'metrics') else []))
+    METRICS.start()
 
 ALIVE.set()
-children["playlist"].start()
 children["downloader"].start()
-children["metadata"].start()
+if "collector" in children:
+    children["collector"].start()
+for _output in OUTPUTS:
+    if _output.playlist.ident is None:
+        _output.playlist.start()
+        _output.metadata.start()
+    if _output.pusher is not None:
+        _output.pusher.start()
 
 signal.signal(signal.SIGINT, cleanup)
 
-logger.info('Starting vamp stream.')
+logger.info('Starting vamp streams.')
 
-ffmpeg_proc = vampstream(FFMPEG, _c)
-try:
-    epoch = children["playlist"].history[0][0]
-    logger.info("Restarting from cached history")
-except IndexError:
-    epoch = time.time()
+for _output in OUTPUTS:
+    _output.vamp = vampstream(FFMPEG, _output.config['USEROPTS'], _output.station.liveurl)
+    try:
+        _output.epoch = _output.playlist.history[0][0]
+        logger.info("Restarting %s from cached history", _output)
+    except IndexError:
+        _output.epoch = time.time()
 time.sleep(5)
-try:
-    if ffmpeg_proc.poll() is not None:
-        logger.error("Failed to start ffmpeg, probably another process still running.")
+
+
+def stopvamp(_output):
+    if _output.vamp is None:
+        return
+    _output.vamp.terminate()
+    #  The playout source can only take the mount once the vamp has let go of it
+    try:
+        _output.vamp.wait(timeout=IcecastRelay.timeout)
+    except subprocess.TimeoutExpired:
+        logger.warning("Vamp stream for %s did not stop, killing it.", _output)
+        _output.vamp.kill()
+    _output.vamp = None
+
+
+def buffering(_output):
+    _remains = (_output.delay - (time.time() - _output.epoch)) / 60 or 1
+    if _remains > 60:
+        logger.info('%s (%0.0f%%) Buffering for %0.1f more %s', _output,
+                    (_output.playlist.qsize * TSLENGTH / _output.delay)*100,
+                    _remains / 60, 'hours' if _remains / 60 > 1 else 'hour')
+    else:
+        logger.info('%s (%0.0f%%) Buffering for %0.0f more %s', _output,
+                    (_output.playlist.qsize * TSLENGTH / _output.delay)*100,
+                    _remains, 'mins' if _remains > 1.9 else 'min')
+    if _output.vamp is not None and _output.vamp.poll() is not None:
+        logger.warning('Restarting vamp stream for %s.', _output)
+        _output.vamp = vampstream(FFMPEG, _output.config['USEROPTS'], _output.station.liveurl)
+    if _output.pusher is not None:
+        _output.pusher.push(f"Realtime Stream: T-{_remains:0.0f} minutes")
+
+
+def nowplaying(_output):
+    _start = _output.sender.timestamp
+    _meta = _output.metadata.lookup(_start)
+    if not _meta:
+        return
+    track = _meta.get('track')
+    artist = _meta.get('artist')
+    album = _meta.get('album')
+    if track == 'Le direct' and time.time() - _output.last_update < TSLENGTH:
+        slug = _output.last_slug
+    else:
+        slug = f'"{track}" by {artist} on {album}'
+    if slug != _output.last_slug:
+        logger.info('Updating metadata for %s at %s for %ss', _output,
+                    int(_meta['startTime']), int(_meta['endTime'] - _start))
+        logger.info(f'Buffer at {(_output.playlist.qsize * TSLENGTH / _output.delay)*100:0.0f}%.')
+        if _output.pusher is not None:
+            _output.pusher.push(slug)
+        _output.last_slug = slug
+        _output.last_update = time.time()
+
+
+for _output in OUTPUTS:
+    if _output.vamp is not None and _output.vamp.poll() is not None:
+        logger.error("Failed to start the vamp stream for %s, probably another process still running.", _output)
         cleanup()
-    _runtime = time.time() - epoch
-    while _runtime < opts.delay:
-        _remains = (opts.delay - _runtime) / 60 or 1
-        if _remains > 60:
-            logger.info('(%0.0f%%) Buffering for %0.1f more %s',
-                        (children["playlist"].qsize * TSLENGTH / opts.delay)*100,
-                        _remains / 60, 'hours' if _remains / 60 > 1 else 'hour')
-        else:
-            logger.info('(%0.0f%%) Buffering for %0.0f more %s',
-                        (children["playlist"].qsize * TSLENGTH / opts.delay)*100,
-                        _remains, 'mins' if _remains > 1.9 else 'min')
-        time.sleep(60)
-        if ffmpeg_proc.poll() is not None:
-            logger.warning('Restarting vamp stream.')
-            ffmpeg_proc = vampstream(FFMPEG, _c)
-        send_metadata(f"{_c['HOST']}:{_c['PORT']}",
-                      _c['MOUNT'],
-                      f"Realtime Stream: T-{_remains:0.0f} minutes",
-                      (_c['USER'], _c['PASSWORD']))
-        _runtime = time.time() - epoch
-except KeyboardInterrupt:
-    logger.info("Killing threads")
-    ffmpeg_proc.terminate()
-    ALIVE.clear()
-    for child in children:
-        if children[child].is_alive():
-            logger.info("Joining %s", children[child].name)
-            children[child].join(timeout=30)
-    cleantmpdir(TMPDIR)
-    sys.exit()
-finally:
-    ffmpeg_proc.terminate()
-    time.sleep(1)
-    if ffmpeg_proc.returncode is None:
-        ffmpeg_proc.kill()
-
-children["sender"].start()
-logger.info("Started %s", children["sender"].name)
-time.sleep(TSLENGTH)  # Wait for buffer to fill
-slug = ''
-last_slug = ''
-last_update = time.time()
+_report = 0
 try:
     while True:
         time.sleep(1)
         for child in children:
-            if not children[child].is_alive():
+            if children[child].ident is not None and not children[child].is_alive():
                 logger.error(f"{children[child].name} died, exiting.")
                 raise SystemExit
-        _start = children["sender"].timestamp
-        _json = children["metadata"].jsoncache
-        track, artist, album = 'Le song', r'¯\_(ツ)_/¯', 'Le album'
-        _meta = {}
-        for _timeidx in _json:
-            if int(_json[_timeidx]['endTime']) > int(_start) >= int(_timeidx):
-                _meta = _json.pop(_timeidx)
-                children["metadata"].jsoncache = _json
-                track = _meta.get('track')
-                artist = _meta.get('artist')
-                album = _meta.get('album')
-                logger.info('Updating metadata at %s for %ss', int(_timeidx), int(_meta['endTime'] - _start))
-                logger.info(f'Buffer at {(children["playlist"].qsize * TSLENGTH / opts.delay)*100:0.0f}%.')
-                break
-        if not _meta:
-            continue
-        if track == 'Le direct' and time.time() - last_update < TSLENGTH:
-            slug = last_slug
-        else:
-            slug = f'"{track}" by {artist} on {album}'
-        if slug != last_slug:
-            if send_metadata(f"{config['USEROPTS']['HOST']}:{config['USEROPTS']['PORT']}",
-                             config['USEROPTS']['MOUNT'],
-                             slug,
-                             (config['USEROPTS']['USER'], config['USEROPTS']['PASSWORD'])):
-                last_slug = slug
-                last_update = time.time()
+        _minute = time.time() - _report > 60
+        for _output in OUTPUTS:
+            if _output.started:
+                nowplaying(_output)
+            elif time.time() - _output.epoch >= _output.delay:
+                stopvamp(_output)
+                _output.sender.start()
+                logger.info("Started %s for %s", _output.sender.name, _output)
+            elif _minute:
+                buffering(_output)
+        if _minute:
+            if not all(_output.started for _output in OUTPUTS):
+                report()
+            _report = time.time()
 
 except KeyboardInterrupt:
     logger.warning("Caught KeyboardInterrupt.")
@@ -225,4 +368,7 @@ except SystemExit:
     logger.warning("Caught SystemExit.")
 finally:
     logger.warning("Main thread exiting.")
+    for _output in OUTPUTS:
+        if _output.vamp is not None:
+            stopvamp(_output)
     cleanup()
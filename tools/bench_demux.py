@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+'''Compare the built-in TS->ADTS demuxer with ffmpeg on recorded segments.'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from fiphifi.demux import ADTSDemuxer  # noqa: E402
+
+
+def bench_python(segments, rounds):
+    _bytes, _frames = 0, 0
+    _start = time.perf_counter()
+    for _ in range(rounds):
+        demuxer = ADTSDemuxer()
+        for _data in segments:
+            for _frame in demuxer.feed(_data):
+                _bytes += len(_frame)
+                _frames += 1
+    return time.perf_counter() - _start, _bytes, _frames
+
+
+def bench_ffmpeg(ffmpeg, paths, rounds):
+    _bytes = 0
+    _start = time.perf_counter()
+    for _ in range(rounds):
+        for _path in paths:
+            p = subprocess.run([ffmpeg, '-loglevel', 'fatal', '-nostdin',
+                                '-i', _path, '-c', 'copy', '-f', 'adts', 'pipe:1'],
+                               capture_output=True)
+            _bytes += len(p.stdout)
+    return time.perf_counter() - _start, _bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('segments', nargs='+', help="Recorded .ts segments.")
+    parser.add_argument('-n', '--rounds', type=int, default=10,
+                        help="Number of passes over the segments.")
+    parser.add_argument('--ffmpeg', default=shutil.which('ffmpeg') or '',
+                        help="Path to ffmpeg, leave empty to skip.")
+    opts = parser.parse_args()
+
+    segments = []
+    for _path in opts.segments:
+        with open(_path, 'rb') as fh:
+            segments.append(fh.read())
+    _size = sum(len(_s) for _s in segments) * opts.rounds / 1024 / 1024
+
+    _elapsed, _bytes, _frames = bench_python(segments, opts.rounds)
+    print(f'python: {_size / _elapsed:0.1f} MB/s in, {_frames / _elapsed:0.0f} frames/s, '
+          f'{_bytes / opts.rounds / 1024:0.0f} kb ADTS per pass')
+    if not opts.ffmpeg:
+        print('ffmpeg: not found, skipped')
+        return
+    _elapsed, _ffbytes = bench_ffmpeg(opts.ffmpeg, opts.segments, opts.rounds)
+    print(f'ffmpeg: {_size / _elapsed:0.1f} MB/s in, '
+          f'{_ffbytes / opts.rounds / 1024:0.0f} kb ADTS per pass')
+
+
+if __name__ == '__main__':
+    main()
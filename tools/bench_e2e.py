@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+'''End-to-end benchmark against a synthetic local FIP origin.
+
+   Serves a sliding fip-style m3u8, MPEG-TS segments of silence, a live
+   ADTS stream and now-playing metadata, optionally with added latency,
+   404s and empty bodies. Then runs fipshift.py against it for a while
+   and reports segment discovery latency, download throughput, queue
+   depths and CPU per hour of stream. With --origin-only it just serves.'''
+
+import os
+import sys
+import copy
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import argparse
+import configparser
+import tempfile
+import threading
+import subprocess
+import collections
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from fiphifi.demux import ADTSDemuxer, SAMPLESPERFRAME  # noqa: E402
+from fiphifi.constants import METATEMPLATE, STRPTIME, TSLENGTH  # noqa: E402
+
+SILENCE = os.path.join(ROOT, 'fiphifi', 'silence_2s.ts')
+AUDIOPID = 0x100
+PMTPID = 0x1000
+
+
+def _crc32(data):
+    #  MPEG-2 CRC: zlib's polynomial, but unreflected and without the final xor
+    _crc = 0xFFFFFFFF
+    for _byte in data:
+        _crc ^= _byte << 24
+        for _ in range(8):
+            _crc = (_crc << 1) ^ 0x04C11DB7 if _crc & 0x80000000 else _crc << 1
+            _crc &= 0xFFFFFFFF
+    return _crc
+
+
+def _section(pid, table):
+    _table = table + _crc32(table).to_bytes(4, 'big')
+    _payload = b'\x00' + _table
+    return bytes([0x47, 0x40 | (pid >> 8), pid & 0xFF, 0x10]) + _payload + b'\xff' * (184 - len(_payload))
+
+
+PAT = _section(0, bytes([0x00, 0xB0, 0x0D, 0x00, 0x01, 0xC1, 0x00, 0x00,
+                         0x00, 0x01, 0xE0 | (PMTPID >> 8), PMTPID & 0xFF]))
+PMT = _section(PMTPID, bytes([0x02, 0xB0, 0x12, 0x00, 0x01, 0xC1, 0x00, 0x00,
+                              0xE0 | (AUDIOPID >> 8), AUDIOPID & 0xFF, 0xF0, 0x00,
+                              0x0F, 0xE0 | (AUDIOPID >> 8), AUDIOPID & 0xFF, 0xF0, 0x00]))
+NULL = bytes([0x47, 0x1F, 0xFF, 0x10]) + b'\xff' * 184
+
+
+def _pts(pts):
+    return bytes([0x21 | ((pts >> 29) & 0x0E), (pts >> 22) & 0xFF, 0x01 | ((pts >> 14) & 0xFE),
+                  (pts >> 7) & 0xFF, 0x01 | ((pts << 1) & 0xFE)])
+
+
+def mux(frames, pts, samplerate, size=0):
+    '''One TS segment: PAT, PMT and a PES per few ADTS frames, padded
+       with null packets to `size` bytes.'''
+    _packets = [PAT, PMT]
+    _cc = 0
+    for _i in range(0, len(frames), 8):
+        _es = b''.join(frames[_i:_i + 8])
+        _pes = b'\x00\x00\x01\xc0' + (len(_es) + 8).to_bytes(2, 'big') + b'\x80\x80\x05' + _pts(pts) + _es
+        pts = (pts + 90000 * SAMPLESPERFRAME * len(frames[_i:_i + 8]) // samplerate) % (1 << 33)
+        _first = True
+        while _pes:
+            _chunk, _pes = _pes[:184], _pes[184:]
+            _header = bytes([0x47, (0x40 if _first else 0) | (AUDIOPID >> 8), AUDIOPID & 0xFF])
+            if len(_chunk) < 184:
+                _stuffing = 184 - len(_chunk) - 1
+                _adaptation = bytes([_stuffing]) + (b'\x00' + b'\xff' * (_stuffing - 1) if _stuffing else b'')
+                _packets.append(_header + bytes([0x30 | _cc]) + _adaptation + _chunk)
+            else:
+                _packets.append(_header + bytes([0x10 | _cc]) + _chunk)
+            _cc = (_cc + 1) & 0x0F
+            _first = False
+    while len(_packets) * 188 < size:
+        _packets.append(NULL)
+    return b''.join(_packets), pts
+
+
+class Origin():
+    '''A live FIP station made up on the spot: a new segment every
+       `duration` seconds, the last `window` of them in the m3u8.'''
+
+    def __init__(self, duration=4, window=20, bitrate=192, track=90,
+                 latency=0, notfound=0, empty=0):
+        with open(SILENCE, 'rb') as fh:
+            _demuxer = ADTSDemuxer()
+            self.frames = [bytes(_f) for _f in _demuxer.feed(fh.read())]
+        self.samplerate = _demuxer.samplerate
+        self.duration = duration
+        self.window = window
+        self.size = int(bitrate * 1000 / 8 * duration)
+        self.track = track
+        self.latency = latency
+        self.notfound = notfound
+        self.empty = empty
+        self.start = int(time.time())
+        self.first = 100000
+        self.segments = collections.OrderedDict()
+        #  name -> when it entered the m3u8, when it was first fetched
+        self.published = {}
+        self.fetched = {}
+        self.lists = 0
+        self.served = 0
+        self.faults = collections.Counter()
+        self.lock = threading.Lock()
+        self._pts = 0
+        self._frame = 0
+        #  Seconds per frame; segments round to whole frames but keep time
+        self._perframe = SAMPLESPERFRAME / self.samplerate
+
+    def tick(self):
+        '''Publish every segment that is due by now.'''
+        _due = int((time.time() - self.start) / self.duration) + 1
+        with self.lock:
+            while len(self.published) < _due:
+                _seq = self.first + len(self.published)
+                _n = int(round(((_seq - self.first + 1) * self.duration) / self._perframe)) - self._frame
+                _frames = [self.frames[(self._frame + _i) % len(self.frames)] for _i in range(_n)]
+                self._frame += _n
+                _data, self._pts = mux(_frames, self._pts, self.samplerate, self.size)
+                _name = f'fip_aac_hifi_4_{self.start}_{_seq}.ts'
+                self.segments[_name] = (_seq, self.start + (_seq - self.first) * self.duration, _data)
+                self.published[_name] = time.time()
+                while len(self.segments) > self.window * 3:
+                    self.segments.popitem(last=False)
+
+    def m3u8(self):
+        self.tick()
+        with self.lock:
+            _live = list(self.segments.items())[-self.window:]
+            self.lists += 1
+        _lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{self.duration}',
+                  f'#EXT-X-MEDIA-SEQUENCE:{_live[0][1][0]}']
+        for _name, (_seq, _timestamp, _data) in _live:
+            _lines.append('#EXT-X-PROGRAM-DATE-TIME:' + time.strftime(STRPTIME, time.gmtime(_timestamp)))
+            _lines.append(f'#EXTINF:{self.duration}.000,')
+            _lines.append(f'/fip/hls/{_name}?id=radiofrance')
+        return ('\n'.join(_lines) + '\n').encode()
+
+    def segment(self, name):
+        '''(status, body) for a segment request, faults included.'''
+        if self.latency:
+            time.sleep(random.uniform(0, self.latency))
+        with self.lock:
+            _segment = self.segments.get(name)
+            if _segment is not None and name not in self.fetched:
+                self.fetched[name] = time.time()
+        if _segment is None:
+            return 404, b''
+        if random.random() < self.notfound:
+            self.faults['404'] += 1
+            return 404, b''
+        if random.random() < self.empty:
+            self.faults['empty'] += 1
+            return 200, b''
+        self.served += len(_segment[2])
+        return 200, _segment[2]
+
+    def metadata(self):
+        _now = time.time()
+        _slot = int(_now // self.track)
+        _json = copy.deepcopy(METATEMPLATE)
+        _json['now']['startTime'] = _slot * self.track
+        _json['now']['endTime'] = (_slot + 1) * self.track
+        _json['now']['media']['startTime'] = _json['now']['startTime']
+        _json['now']['media']['endTime'] = _json['now']['endTime']
+        _json['now']['firstLine']['title'] = f'Track {_slot % 1000}'
+        _json['delayToRefresh'] = int(((_slot + 1) * self.track - _now) * 1000) + 1000
+        return json.dumps(_json).encode()
+
+    def live(self, wfile):
+        '''Real-time ADTS for the vamp stream, until the client hangs up.'''
+        _start = time.monotonic()
+        _sent = 0
+        while True:
+            _due = int((time.monotonic() - _start) / self._perframe) + 10
+            _chunk = b''.join(self.frames[_i % len(self.frames)] for _i in range(_sent, _due))
+            _sent = _due
+            wfile.write(_chunk)
+            wfile.flush()
+            time.sleep(0.1)
+
+    def discovery(self):
+        '''Seconds from entering the m3u8 to the first fetch, per segment.'''
+        with self.lock:
+            return sorted(self.fetched[_name] - self.published[_name] for _name in self.fetched)
+
+    def serve(self, host, port):
+        _origin = self
+
+        class _Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                _path = self.path.split('?')[0]
+                try:
+                    if _path == '/fip/fip_hifi.m3u8':
+                        self.reply(200, _origin.m3u8(), 'application/vnd.apple.mpegurl')
+                    elif _path.startswith('/fip/hls/'):
+                        self.reply(*_origin.segment(os.path.basename(_path)), 'video/mp2t')
+                    elif _path.startswith('/api/live'):
+                        self.reply(200, _origin.metadata(), 'application/json')
+                    elif _path == '/fip-hifi.aac':
+                        self.protocol_version = 'HTTP/1.0'
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'audio/aac')
+                        self.end_headers()
+                        _origin.live(self.wfile)
+                    else:
+                        self.reply(404, b'', 'text/plain')
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def reply(self, status, body, kind):
+                self.send_response(status)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        ThreadingHTTPServer.allow_reuse_address = True
+        _server = ThreadingHTTPServer((host, port), _Handler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return _server
+
+
+def freeport():
+    with socket.socket() as _sock:
+        _sock.bind(('127.0.0.1', 0))
+        return _sock.getsockname()[1]
+
+
+def scrape(url):
+    '''{(name, labels): value} from a Prometheus text page.'''
+    _samples = {}
+    try:
+        with urllib.request.urlopen(url, timeout=2) as req:
+            _text = req.read().decode()
+    except OSError:
+        return _samples
+    for _line in _text.splitlines():
+        if not _line or _line[0] == '#':
+            continue
+        _key, _, _value = _line.rpartition(' ')
+        _samples[_key] = float(_value)
+    return _samples
+
+
+def cputime(pid):
+    '''User plus system seconds of a process, from /proc.'''
+    with open(f'/proc/{pid}/stat') as fh:
+        _fields = fh.read().rsplit(')', 1)[1].split()
+    return (int(_fields[11]) + int(_fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=0, help="Origin port (default: any free one).")
+    parser.add_argument('--duration', type=float, default=300, help="Seconds to run fipshift for.")
+    parser.add_argument('--delay', type=int, default=60, help="Delay in seconds to run fipshift with.")
+    parser.add_argument('--playout', default='http', choices=('http', 'hls', 'native', 'ffmpeg'),
+                        help="PLAYOUT for fipshift; native and ffmpeg need tools/icecast_standin.py.")
+    parser.add_argument('--store', default='ring', choices=('ring', 'files', 'memory'))
+    parser.add_argument('--asyncio', action='store_true',
+                        help="Run fipshift with --asyncio. It serves no /metrics, so downloads are "
+                             "counted at the origin and queue depths are not reported.")
+    parser.add_argument('--window', type=int, default=20, help="Segments in the m3u8.")
+    parser.add_argument('--bitrate', type=int, default=192, help="kbps the segments are padded to.")
+    parser.add_argument('--latency', type=float, default=0, help="Up to this many seconds added per segment.")
+    parser.add_argument('--notfound', type=float, default=0, help="Fraction of segment requests answered 404.")
+    parser.add_argument('--empty', type=float, default=0, help="Fraction of segment requests answered empty.")
+    parser.add_argument('--origin-only', action='store_true', help="Serve the origin and nothing else.")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary directory.")
+    opts = parser.parse_args()
+
+    origin = Origin(TSLENGTH, opts.window, opts.bitrate, latency=opts.latency,
+                    notfound=opts.notfound, empty=opts.empty)
+    port = opts.port or freeport()
+    origin.serve('127.0.0.1', port)
+    base = f'http://127.0.0.1:{port}'
+    print(f'Origin at {base}/fip/fip_hifi.m3u8')
+    if opts.origin_only:
+        try:
+            while True:
+                time.sleep(60)
+                print(f'{len(origin.published)} segments published, {len(origin.fetched)} fetched, '
+                      f'{origin.lists} lists, {origin.served / 1024 / 1024:0.1f} MB served')
+        except KeyboardInterrupt:
+            return
+
+    tmpdir = tempfile.mkdtemp(prefix='fipshift-bench-')
+    metricsport = freeport()
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, 'template.conf'))
+    config['USEROPTS'].update({'TMPDIR': tmpdir, 'PLAYOUT': opts.playout, 'STORE': opts.store,
+                               'MOUNT': 'fip.aac', 'LISTENHOST': '127.0.0.1', 'LISTENPORT': str(freeport()),
+                               'METRICSPORT': str(metricsport),
+                               #  Only run with PLAYOUT=ffmpeg, but it has to exist either way
+                               'FFMPEG': shutil.which('ffmpeg') or sys.executable})
+    config['fip'] = {'LISTURL': f'{base}/fip/fip_hifi.m3u8?id=radiofrance',
+                     'METAURL': f'{base}/api/live?',
+                     'LIVEURL': f'{base}/fip-hifi.aac?id=radiofrance'}
+    with open(os.path.join(tmpdir, 'fipshift.conf'), 'w') as fh:
+        config.write(fh)
+    _cmd = [sys.executable, os.path.join(ROOT, 'fipshift.py'),
+            '--configdir', tmpdir, '-z', str(opts.delay)]
+    if opts.asyncio:
+        _cmd.append('--asyncio')
+    print(f'Running fipshift for {opts.duration:0.0f}s at a {opts.delay}s delay in {tmpdir}')
+    depths = collections.defaultdict(list)
+    samples = {}
+    _start = time.monotonic()
+    with open(os.path.join(tmpdir, 'stderr.log'), 'w') as _stderr:
+        proc = subprocess.Popen(_cmd, stdout=subprocess.DEVNULL, stderr=_stderr)
+        try:
+            while time.monotonic() - _start < opts.duration and proc.poll() is None:
+                time.sleep(5)
+                if opts.asyncio:
+                    continue
+                samples = scrape(f'http://127.0.0.1:{metricsport}/metrics') or samples
+                for _key, _value in samples.items():
+                    if _key.startswith('fipshift_stage_depth'):
+                        depths[_key.split('"')[1]].append(_value)
+            _cpu = cputime(proc.pid) if proc.poll() is None else 0
+        finally:
+            _elapsed = time.monotonic() - _start
+            #  SIGINT is what fipshift cleans up on; anything else skips it
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+    _failed = proc.returncode not in (0, -signal.SIGINT)
+    if _failed:
+        print(f'fipshift exited with {proc.returncode}, see {tmpdir}')
+
+    _discovery = origin.discovery()
+    print(f'\nSegments: {len(origin.published)} published, {len(origin.fetched)} fetched, faults {dict(origin.faults)}')
+    print(f'Discovery latency: p50 {percentile(_discovery, 0.5):0.2f}s  p95 {percentile(_discovery, 0.95):0.2f}s  '
+          f'max {percentile(_discovery, 1):0.2f}s')
+    if opts.asyncio:
+        print(f'Download: {origin.served / 1024 / 1024:0.1f} MB served by the origin '
+              f'({origin.served * 8 / 1000 / _elapsed:0.0f} kbps)')
+        print('Queue depths: not reported, the asyncio runtime serves no /metrics')
+    else:
+        _bytes = sum(_v for _k, _v in samples.items() if _k.startswith('fipshift_download_bytes_total'))
+        _count = samples.get('fipshift_download_seconds_count', 0)
+        _mean = samples.get('fipshift_download_seconds_sum', 0) / _count if _count else 0
+        print(f'Download: {_bytes / 1024 / 1024:0.1f} MB ({_bytes * 8 / 1000 / _elapsed:0.0f} kbps), '
+              f'{_count:0.0f} fetches, {_mean * 1000:0.0f} ms mean, '
+              f'origin served {origin.served / 1024 / 1024:0.1f} MB')
+    for _stage, _values in sorted(depths.items()):
+        print(f'Queue {_stage:<24} mean {sum(_values) / len(_values):6.1f}  max {max(_values):6.0f}')
+    if _cpu:
+        print(f'CPU: {_cpu:0.1f}s in {_elapsed:0.0f}s, {_cpu * 3600 / _elapsed:0.0f}s per hour of stream')
+    #  Keep the logs of a run that went wrong
+    if not opts.keep and not _failed:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+'''Time FipPlaylist history lookups: the old list scan against SegmentIndex.'''
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from fiphifi.history import SegmentIndex  # noqa: E402
+from fiphifi.util import parsets  # noqa: E402
+from fiphifi.constants import FIPBASEURL, TSLENGTH  # noqa: E402
+
+
+def entries(n, start=1711410121, prefix=4):
+    for _i in range(n):
+        yield [start + _i * TSLENGTH, f'{FIPBASEURL}/fip/hls/fip_aac_hifi_{prefix}_{start}_{100000 + _i}.ts?id=radiofrance']
+
+
+def bench(label, fn, rounds):
+    _start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    _elapsed = (time.perf_counter() - _start) / rounds
+    print(f'{label:<32} {_elapsed * 1e6:10.1f} us')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--poll', type=int, default=30,
+                        help="Lines of m3u8 checked per poll.")
+    parser.add_argument('-n', '--rounds', type=int, default=20)
+    opts = parser.parse_args()
+
+    n = int(opts.hours * 3600 / TSLENGTH)
+    history = list(entries(n))
+    index = SegmentIndex(history)
+    poll = history[-opts.poll:]
+    print(f'{n} entries ({opts.hours:0.0f} h), {opts.poll} urls per poll')
+
+    bench('list scan per poll', lambda: [_url in history for _url in poll], opts.rounds)
+    bench('SegmentIndex per poll', lambda: [tuple(parsets(_url[1])) in index for _url in poll], opts.rounds)
+    bench('list prune one hour', lambda: list(history)[900:], opts.rounds)
+
+    def _evict():
+        _index = SegmentIndex()
+        _index._index = index._index.copy()
+        _t = time.perf_counter()
+        _index.evict(900)
+        return time.perf_counter() - _t
+    _elapsed = sum(_evict() for _ in range(opts.rounds)) / opts.rounds
+    print(f'{"SegmentIndex evict one hour":<32} {_elapsed * 1e6:10.1f} us')
+
+
+if __name__ == '__main__':
+    main()
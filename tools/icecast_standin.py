@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+'''Local stand-in for an Icecast server: accepts source connections and
+   metadata updates, counts bytes per mount and can drop sources on purpose.'''
+
+import time
+import argparse
+import threading
+import socketserver
+from urllib.parse import urlparse, parse_qs
+
+STATS = {}
+LOCK = threading.Lock()
+
+
+class IcecastHandler(socketserver.StreamRequestHandler):
+
+    drop = 0
+    record = None
+
+    def handle(self):
+        _line = self.rfile.readline().decode(errors='replace').split()
+        if len(_line) < 2:
+            return
+        _method, _path = _line[0], _line[1]
+        _headers = {}
+        while True:
+            _h = self.rfile.readline().decode(errors='replace').strip()
+            if not _h:
+                break
+            _k, _, _v = _h.partition(':')
+            _headers[_k.strip().lower()] = _v.strip()
+        if _method in ('PUT', 'SOURCE'):
+            self.source(_path, _headers)
+        elif _path.startswith('/admin/metadata'):
+            self.metadata(_path)
+        else:
+            self.wfile.write(b'HTTP/1.0 404 Not Found\r\n\r\n')
+
+    def source(self, mount, headers):
+        if headers.get('expect', '').lower() == '100-continue':
+            self.wfile.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        else:
+            self.wfile.write(b'HTTP/1.0 200 OK\r\n\r\n')
+        self.wfile.flush()
+        with LOCK:
+            _stats = STATS.setdefault(mount, {'bytes': 0, 'connects': 0, 'metadata': 0})
+            _stats['connects'] += 1
+        print(f'{mount}: source connected ({_stats["connects"]}) {headers.get("ice-name", "")}')
+        _start = time.monotonic()
+        _out = open(self.record, 'ab') if self.record else None
+        try:
+            while True:
+                _chunk = self.request.recv(65536)
+                if not _chunk:
+                    break
+                if _out is not None:
+                    _out.write(_chunk)
+                with LOCK:
+                    _stats['bytes'] += len(_chunk)
+                if self.drop and time.monotonic() - _start > self.drop:
+                    print(f'{mount}: dropping source on purpose')
+                    break
+        except OSError:
+            pass
+        finally:
+            if _out is not None:
+                _out.close()
+        print(f'{mount}: source gone after {time.monotonic() - _start:0.1f}s')
+
+    def metadata(self, path):
+        _q = parse_qs(urlparse(path).query)
+        _mount = _q.get('mount', ['/'])[0]
+        with LOCK:
+            STATS.setdefault(_mount, {'bytes': 0, 'connects': 0, 'metadata': 0})['metadata'] += 1
+        print(f'{_mount}: metadata {_q.get("song", [""])[0]}')
+        _body = b'<?xml version="1.0"?>\n<iceresponse><message>Metadata update successful</message>'\
+                b'<return>1</return></iceresponse>\n'
+        self.wfile.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/xml\r\nContent-Length: '
+                         + str(len(_body)).encode() + b'\r\n\r\n' + _body)
+
+
+def report(interval):
+    _last = {}
+    while True:
+        time.sleep(interval)
+        with LOCK:
+            for _mount, _stats in STATS.items():
+                _rate = (_stats['bytes'] - _last.get(_mount, 0)) * 8 / 1000 / interval
+                _last[_mount] = _stats['bytes']
+                print(f'{_mount}: {_rate:0.0f} kbps, {_stats["bytes"] / 1024:0.0f} kb, '
+                      f'{_stats["connects"]} connects, {_stats["metadata"]} metadata updates')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--drop', type=float, default=0,
+                        help="Drop every source connection after this many seconds.")
+    parser.add_argument('--record', default=None,
+                        help="Append everything received to this file.")
+    parser.add_argument('--interval', type=float, default=10,
+                        help="Seconds between reports.")
+    opts = parser.parse_args()
+    IcecastHandler.drop = opts.drop
+    IcecastHandler.record = opts.record
+    threading.Thread(target=report, args=(opts.interval,), daemon=True).start()
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer((opts.host, opts.port), IcecastHandler) as server:
+        print(f'Stand-in icecast listening on {opts.host}:{opts.port}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()